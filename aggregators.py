@@ -0,0 +1,493 @@
+import os
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+import profiling
+
+"""
+Aggregators for the single pass of gap.py over the seq files.
+
+The file walker in gap.py tokenizes every %S, %T and %U line once and calls
+update(seq_id, line_type, values) on each registered aggregator, where line_type is
+"S", "T" or "U" and values are the number tokens of the line as bytes. As gap.py has
+always counted them, the tokens include the A-number at the start of the line, so
+values[0] is the sequence's own id. The occurrence counts and the index keep it, the
+statistics about the terms (sequences, lines, lengths) skip it. end_file(seq_id) is
+called after each file.
+
+In parallel runs every worker process gets fresh copies from spawn() and the main
+process combines the returned copies with merge(), so an aggregator works unchanged in
+serial and parallel runs. finish() is called once at the end, report() prints and saves
+the results.
+"""
+
+# Values in [0, DEFAULT_DENSE_LIMIT) and [-DEFAULT_NEGATIVE_LIMIT, 0) are counted in dense arrays
+DEFAULT_DENSE_LIMIT = 10**7
+DEFAULT_NEGATIVE_LIMIT = 10**4
+
+# Number of distinct byte tokens buffered before they are converted and added to the counts
+FLUSH_TOKENS = 10**6
+
+# The gap bitmap covers at most the values in [0, DEFAULT_GAP_LIMIT)
+DEFAULT_GAP_LIMIT = 2**27
+
+# Only numbers in this range are stored in the inverted index
+INDEX_MIN = -2**63
+INDEX_MAX = 2**63
+
+def to_int_counts(token_counts):
+    """Convert counts keyed by byte tokens to counts keyed by int, converting each token once."""
+    counts = Counter()
+    for token, count in token_counts.items():
+        counts[int(token)] += count
+    return counts
+
+class CompactCounter:
+    """
+    Counter for integers backed by dense NumPy arrays.
+
+    Values in [0, dense_limit) are counted in one array, values in [-negative_limit, 0) in
+    a second one and all other values spill into a dict. The dense parts are already sorted,
+    so only the spilled values have to be sorted when the counts are exported.
+    """
+
+    def __init__(self, dense_limit=DEFAULT_DENSE_LIMIT, negative_limit=DEFAULT_NEGATIVE_LIMIT):
+        self.positive = np.zeros(dense_limit, dtype=np.int64)
+        self.negative = np.zeros(negative_limit, dtype=np.int64)  # index i counts -(i + 1)
+        self.spill = {}
+
+    def update(self, counts, sign=1):
+        """Add a mapping of numbers (int or byte tokens) to counts."""
+        dense_limit = len(self.positive)
+        negative_limit = len(self.negative)
+        spill = self.spill
+        positive_index, positive_count = [], []
+        negative_index, negative_count = [], []
+        for token, count in counts.items():
+            number = int(token)
+            if 0 <= number < dense_limit:
+                positive_index.append(number)
+                positive_count.append(count)
+            elif -negative_limit <= number < 0:
+                negative_index.append(-number - 1)
+                negative_count.append(count)
+            else:
+                total = spill.get(number, 0) + sign * count
+                if total > 0:
+                    spill[number] = total
+                else:
+                    spill.pop(number, None)
+        # add.at handles repeated indices, e.g. the tokens b"7" and b"07"
+        np.add.at(self.positive, np.array(positive_index, dtype=np.int64), sign * np.array(positive_count, dtype=np.int64))
+        np.add.at(self.negative, np.array(negative_index, dtype=np.int64), sign * np.array(negative_count, dtype=np.int64))
+
+    def subtract(self, counts):
+        """Remove a mapping of numbers to counts, dropping numbers that no longer occur."""
+        self.update(counts, sign=-1)
+
+    def merge(self, other):
+        """Add the counts of another CompactCounter with the same limits."""
+        self.positive += other.positive
+        self.negative += other.negative
+        for number, count in other.spill.items():
+            self.spill[number] = self.spill.get(number, 0) + count
+
+    def __getitem__(self, number):
+        if 0 <= number < len(self.positive):
+            return int(self.positive[number])
+        if -len(self.negative) <= number < 0:
+            return int(self.negative[-number - 1])
+        return self.spill.get(number, 0)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.positive)) + int(np.count_nonzero(self.negative)) + len(self.spill)
+
+    def to_frame(self):
+        """Return a DataFrame with the columns Number and Count, sorted by Number."""
+        spill_numbers = sorted(self.spill)
+        split = next((i for i, number in enumerate(spill_numbers) if number >= 0), len(spill_numbers))
+        negative_index = np.flatnonzero(self.negative)[::-1]
+        positive_index = np.flatnonzero(self.positive)
+        parts = [
+            (np.array(spill_numbers[:split], dtype=object), [self.spill[n] for n in spill_numbers[:split]]),
+            (-negative_index - 1, self.negative[negative_index]),
+            (positive_index, self.positive[positive_index]),
+            (np.array(spill_numbers[split:], dtype=object), [self.spill[n] for n in spill_numbers[split:]]),
+        ]
+        numbers = np.concatenate([part[0] for part in parts])
+        if numbers.dtype == object and all(-2**63 <= n < 2**63 for n in spill_numbers):
+            numbers = numbers.astype(np.int64)
+        counts = np.concatenate([np.asarray(part[1], dtype=np.int64) for part in parts])
+        return pd.DataFrame({"Number": numbers, "Count": counts})
+
+class GapTracker:
+    """
+    Tracks the smallest non-negative integers that do not occur.
+
+    Presence is recorded in a bitmap that grows as needed up to max_bits, and first_zero
+    points to the first value that has not been seen yet. Values at or beyond max_bits are
+    ignored; if every value below max_bits occurs, first_zero is None.
+    """
+
+    # Number of bitmap bytes searched at once when looking for zero bits
+    BLOCK_SIZE = 2**16
+
+    def __init__(self, max_bits=DEFAULT_GAP_LIMIT, initial_bits=2**16):
+        self.max_bits = -(-max_bits // 8) * 8
+        self.bits = np.zeros(min(initial_bits, self.max_bits) // 8, dtype=np.uint8)
+        self.first_zero = 0
+
+    def add(self, numbers):
+        """Mark the numbers of an iterable or integer array as present."""
+        if isinstance(numbers, np.ndarray):
+            index = numbers[(numbers >= 0) & (numbers < self.max_bits)].astype(np.int64)
+        else:
+            index = np.fromiter((n for n in numbers if 0 <= n < self.max_bits), dtype=np.int64)
+        if not len(index):
+            return
+        self._grow(int(index.max()) + 1)
+        np.bitwise_or.at(self.bits, index >> 3, np.left_shift(1, index & 7).astype(np.uint8))
+        self._advance()
+
+    def merge(self, other):
+        """Mark the values seen by another GapTracker as present."""
+        self._grow(len(other.bits) * 8)
+        self.bits[:len(other.bits)] |= other.bits
+        self._advance()
+
+    def _grow(self, needed):
+        """Grow the bitmap by doubling until it covers the values below needed (at most max_bits)."""
+        if needed > len(self.bits) * 8:
+            size = max(len(self.bits) * 8, 8)
+            while size < needed:
+                size *= 2
+            size = min(size, self.max_bits)
+            self.bits = np.concatenate([self.bits, np.zeros(size // 8 - len(self.bits), dtype=np.uint8)])
+
+    def _advance(self):
+        """Move first_zero forward to the first value that has not been seen."""
+        if self.first_zero is not None:
+            zeros = self.zeros(1, self.first_zero)
+            self.first_zero = zeros[0] if zeros else None
+
+    def zeros(self, k, start=0):
+        """Return up to k values from start on that have not been seen, in increasing order."""
+        found = []
+        byte = start >> 3
+        while len(found) < k and byte < len(self.bits):
+            block = self.bits[byte:byte + self.BLOCK_SIZE]
+            for offset in np.flatnonzero(block != 0xFF):
+                bit_values = np.unpackbits(block[offset:offset + 1], bitorder="little")
+                base = (byte + offset) * 8
+                found.extend(base + int(bit) for bit in np.flatnonzero(bit_values == 0) if base + bit >= start)
+                if len(found) >= k:
+                    break
+            byte += self.BLOCK_SIZE
+        # Values beyond the current bitmap were never seen
+        end = min(max(len(self.bits) * 8, start), self.max_bits)
+        found.extend(range(end, min(end + k - len(found), self.max_bits)) if len(found) < k else [])
+        return found[:k]
+
+    def first_gaps(self, k):
+        """Return the first k non-negative integers that do not occur (fewer if max_bits is reached)."""
+        if self.first_zero is None:
+            return []
+        return self.zeros(k, self.first_zero)
+
+    @classmethod
+    def from_counts(cls, number_counts, max_bits=DEFAULT_GAP_LIMIT):
+        """Build a tracker from the non-negative values of a CompactCounter."""
+        tracker = cls(max_bits)
+        tracker.add(np.flatnonzero(number_counts.positive))
+        tracker.add(number for number in number_counts.spill if number >= 0)
+        return tracker
+
+def encode_varints(values):
+    """Encode an array of non-negative integers as LEB128 varints, returns (bytes, start offsets)."""
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28, 35, 42, 49, 56, 63):
+        lengths += values >= np.uint64(1 << shift)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+    encoded = np.zeros(int(lengths.sum()), dtype=np.uint8)
+    for byte in range(int(lengths.max()) if len(values) else 0):
+        has_byte = lengths > byte
+        chunk = (values[has_byte] >> np.uint64(7 * byte)) & np.uint64(0x7F)
+        more = (lengths[has_byte] > byte + 1).astype(np.uint64) << np.uint64(7)
+        encoded[starts[has_byte] + byte] = (chunk | more).astype(np.uint8)
+    return encoded, starts
+
+class Aggregator:
+    """Base class of the statistics computed in one pass over the seq files."""
+
+    # Name used to select the aggregator with gap.py --stats
+    name = None
+
+    def spawn(self):
+        """Return a new, empty aggregator with the same settings, e.g. for a worker process."""
+        return type(self)()
+
+    def update(self, seq_id, line_type, values):
+        """Process the number tokens of one %S, %T or %U line."""
+        raise NotImplementedError
+
+    def end_file(self, seq_id):
+        """Called after the last line of a file."""
+
+    def merge(self, other):
+        """Add the results of another aggregator of the same type."""
+        raise NotImplementedError
+
+    def finish(self):
+        """Called once after all files are processed and merged."""
+
+    def report(self):
+        """Print and save the results."""
+
+class BufferedCounts:
+    """
+    Counts numbers in a CompactCounter, buffering them in a dict first.
+
+    Keys of the buffer may be byte tokens or ints. When the buffer holds FLUSH_TOKENS
+    distinct keys, each key is converted to int once and added to the CompactCounter.
+    The CompactCounter is only allocated on the first flush, so the copies in worker
+    processes stay small.
+    """
+
+    def __init__(self, dense_limit=DEFAULT_DENSE_LIMIT):
+        self.dense_limit = dense_limit
+        self.buffer = Counter()
+        self.counts = None
+
+    def flush(self):
+        """Add the buffer to the counts and return it converted to int keys."""
+        with profiling.profile.phase("int conversion"):
+            numbers = to_int_counts(self.buffer)
+        if self.counts is None:
+            self.counts = CompactCounter(self.dense_limit)
+        with profiling.profile.phase("counter update"):
+            self.counts.update(numbers)
+        self.buffer = Counter()
+        return numbers
+
+    def full(self):
+        return len(self.buffer) >= FLUSH_TOKENS
+
+    def merge(self, other):
+        self.buffer.update(other.buffer)
+        if other.counts is not None:
+            if self.counts is None:
+                self.counts = CompactCounter(self.dense_limit)
+            self.counts.merge(other.counts)
+
+class OccurrenceCounts(Aggregator):
+    """
+    Counts how often every number occurs and tracks the first gaps.
+
+    The results are in counts (a CompactCounter) and gap_tracker (a GapTracker) after
+    finish(). Reporting them is left to gap.py.
+    """
+
+    name = "counts"
+
+    def __init__(self, dense_limit=DEFAULT_DENSE_LIMIT):
+        self.numbers = BufferedCounts(dense_limit)
+        self.gap_tracker = None
+
+    def spawn(self):
+        return OccurrenceCounts(self.numbers.dense_limit)
+
+    @property
+    def counts(self):
+        return self.numbers.counts
+
+    def update(self, seq_id, line_type, values):
+        self.numbers.buffer.update(values)
+
+    def end_file(self, seq_id):
+        if self.numbers.full():
+            self.flush()
+
+    def flush(self):
+        numbers = self.numbers.flush()
+        if self.gap_tracker is None:
+            self.gap_tracker = GapTracker()
+        self.gap_tracker.add(numbers)
+
+    def merge(self, other):
+        self.numbers.merge(other.numbers)
+        if other.gap_tracker is not None:
+            if self.gap_tracker is None:
+                self.gap_tracker = GapTracker()
+            self.gap_tracker.merge(other.gap_tracker)
+        if self.numbers.full():
+            self.flush()
+
+    def finish(self):
+        self.flush()
+
+class SequenceCounts(Aggregator):
+    """Counts in how many distinct sequences every number occurs."""
+
+    name = "sequences"
+    csv_path = "sequence_counts.csv"
+
+    def __init__(self, dense_limit=DEFAULT_DENSE_LIMIT):
+        self.numbers = BufferedCounts(dense_limit)
+        self.current = set()
+
+    def spawn(self):
+        return SequenceCounts(self.numbers.dense_limit)
+
+    def update(self, seq_id, line_type, values):
+        self.current.update(values[1:])  # Without the A-number
+
+    def end_file(self, seq_id):
+        # b"7" and b"07" are the same number, so the distinct values are taken as ints
+        self.numbers.buffer.update(set(map(int, self.current)))
+        self.current = set()
+        if self.numbers.full():
+            self.numbers.flush()
+
+    def merge(self, other):
+        self.numbers.merge(other.numbers)
+        if self.numbers.full():
+            self.numbers.flush()
+
+    def finish(self):
+        self.numbers.flush()
+
+    def report(self):
+        df = self.numbers.counts.to_frame().rename(columns={"Count": "Sequences"})
+        df.to_csv(self.csv_path, index=False)
+        print(f"Number of sequences containing each number saved to {self.csv_path}.")
+
+class LineTypeCounts(Aggregator):
+    """Counts the lines and terms per line type (%S, %T, %U)."""
+
+    name = "lines"
+    csv_path = "line_type_counts.csv"
+
+    def __init__(self):
+        self.lines = Counter()
+        self.tokens = Counter()
+
+    def update(self, seq_id, line_type, values):
+        self.lines[line_type] += 1
+        self.tokens[line_type] += len(values[1:])  # Without the A-number
+
+    def merge(self, other):
+        self.lines.update(other.lines)
+        self.tokens.update(other.tokens)
+
+    def report(self):
+        df = pd.DataFrame({
+            "LineType": [f"%{line_type}" for line_type in sorted(self.lines)],
+            "Lines": [self.lines[line_type] for line_type in sorted(self.lines)],
+            "Terms": [self.tokens[line_type] for line_type in sorted(self.lines)],
+        })
+        df.to_csv(self.csv_path, index=False)
+        for row in df.itertuples():
+            print(f"{row.LineType} lines: {row.Lines}, terms: {row.Terms}")
+        print(f"Line type statistics saved to {self.csv_path}.")
+
+class TermLengths(Aggregator):
+    """Histogram of the number of digits of the terms."""
+
+    name = "lengths"
+    csv_path = "term_lengths.csv"
+
+    def __init__(self):
+        self.lengths = Counter()
+
+    def update(self, seq_id, line_type, values):
+        # values[0] is the A-number, not a term
+        self.lengths.update(len(value) - value.startswith(b"-") for value in values[1:])
+
+    def merge(self, other):
+        self.lengths.update(other.lengths)
+
+    def report(self):
+        digits = sorted(self.lengths)
+        df = pd.DataFrame({"Digits": digits, "Count": [self.lengths[d] for d in digits]})
+        df.to_csv(self.csv_path, index=False)
+        print(f"Longest term: {digits[-1] if digits else 0} digits.")
+        print(f"Term length histogram saved to {self.csv_path}.")
+
+class IndexBuilder(Aggregator):
+    """
+    Collects (number, sequence id) pairs and writes them as an inverted index.
+
+    Numbers outside of int64 are not indexed.
+
+    The index directory holds three .npy files:
+    - keys.npy: the sorted distinct numbers (int64)
+    - offsets.npy: byte offsets of the postings of every key, with a final end offset
+    - postings.npy: for every key the sorted sequence ids as varints, the first one
+      absolute and the others as differences to the previous id
+    """
+
+    name = "index"
+
+    def __init__(self, index_dir=None):
+        self.index_dir = index_dir
+        self.numbers = []
+        self.seq_ids = []
+        self.current = set()
+
+    def spawn(self):
+        return IndexBuilder(self.index_dir)
+
+    def update(self, seq_id, line_type, values):
+        self.current.update(values)
+
+    def end_file(self, seq_id):
+        numbers = {n for n in map(int, self.current) if INDEX_MIN <= n < INDEX_MAX}
+        self.add(list(numbers), np.full(len(numbers), seq_id))
+        self.current = set()
+
+    def merge(self, other):
+        self.numbers.extend(other.numbers)
+        self.seq_ids.extend(other.seq_ids)
+
+    def add(self, numbers, seq_ids):
+        """Add arrays of numbers and the sequence ids they occur in."""
+        self.numbers.append(np.asarray(numbers, dtype=np.int64))
+        self.seq_ids.append(np.asarray(seq_ids, dtype=np.int64))
+
+    def add_counts(self, seq_id, counts):
+        """Add the numbers of one sequence, given as a mapping from number to count."""
+        numbers = [n for n in counts if INDEX_MIN <= n < INDEX_MAX]
+        self.add(numbers, np.full(len(numbers), seq_id))
+
+    def report(self):
+        keys, postings = self.write(self.index_dir)
+        print(f"Inverted index with {keys} numbers and {postings} postings saved to {self.index_dir}.")
+
+    def write(self, index_dir):
+        """Sort the collected pairs and write the index files to index_dir."""
+        numbers = np.concatenate(self.numbers) if self.numbers else np.zeros(0, dtype=np.int64)
+        seq_ids = np.concatenate(self.seq_ids) if self.seq_ids else np.zeros(0, dtype=np.int64)
+        order = np.lexsort((seq_ids, numbers))
+        numbers, seq_ids = numbers[order], seq_ids[order]
+        # Drop repeated pairs, e.g. from the tokens b"7" and b"07" of one file
+        keep = np.ones(len(numbers), dtype=bool)
+        keep[1:] = (numbers[1:] != numbers[:-1]) | (seq_ids[1:] != seq_ids[:-1])
+        numbers, seq_ids = numbers[keep], seq_ids[keep]
+
+        new_key = np.ones(len(numbers), dtype=bool)
+        new_key[1:] = numbers[1:] != numbers[:-1]
+        deltas = seq_ids.copy()
+        deltas[~new_key] = seq_ids[~new_key] - seq_ids[np.flatnonzero(~new_key) - 1]
+        postings, starts = encode_varints(deltas)
+        offsets = np.append(starts[new_key], len(postings)).astype(np.int64)
+
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, "keys.npy"), numbers[new_key])
+        np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+        np.save(os.path.join(index_dir, "postings.npy"), postings)
+        return int(new_key.sum()), len(numbers)
+
+# Additional statistics that can be selected with gap.py --stats
+AGGREGATORS = {aggregator.name: aggregator for aggregator in (SequenceCounts, LineTypeCounts, TermLengths)}
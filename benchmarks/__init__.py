@@ -0,0 +1 @@
+"""Benchmarks for the oeistools scripts. Run them from the repository root with python -m."""
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from benchmarks.synthetic import DEFAULT_BIGNUM_SHARE, DEFAULT_FILES, generate_tree
+
+"""
+Stage benchmarks of gap.py, plot_counts.py and sonification.py on a synthetic seq tree.
+
+Generates a seq tree with benchmarks.synthetic (or uses an existing one with --data) and
+times the stages separately:
+
+- scan: tokenizing and counting all files with the gap.py pipeline
+- export: DataFrame conversion and CSV output of the full and trimmed counts
+- classify: the number categories of plot_counts.py for the trimmed counts
+- plot: drawing and saving the plot of the trimmed counts
+- midi: gaps, note mapping and MIDI file of a long synthetic sequence
+
+Every stage runs in a fresh process, so its peak RSS is not inflated by the stages before
+it. The setup of a stage (e.g. the scan that the export stage needs) is not timed, but it
+counts towards the peak RSS. The results are written as JSON, one object per run, so runs
+can be compared over time.
+
+Run from the repository root:
+    python -m benchmarks.stages -n 20000 -o bench.json
+"""
+
+STAGES = ["scan", "export", "classify", "plot", "midi"]
+DEFAULT_MIDI_TERMS = 10000
+
+def cpu_time():
+    """User and system time of this process and of the worker processes it waited for."""
+    return sum(os.times()[:4])
+
+class StageTimer:
+    """Wall and CPU time of the timed part of a stage."""
+
+    def __enter__(self):
+        self.wall = -time.perf_counter()
+        self.cpu = -cpu_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall += time.perf_counter()
+        self.cpu += cpu_time()
+
+def scan_counts(data_path, workers):
+    """Count the numbers of a seq folder with the gap.py pipeline."""
+    from gap import run_pipeline
+    from corpus import DirectorySource
+    from aggregators import OccurrenceCounts
+
+    source = DirectorySource(data_path)
+    occurrences = OccurrenceCounts()
+    run_pipeline(source, [occurrences], workers=workers)
+    return source.total, occurrences.counts
+
+def trimmed_numbers(data_path, workers, cutoff):
+    """Return the numbers and counts below cutoff, as plot_counts.py reads them."""
+    number_counts = scan_counts(data_path, workers)[1]
+    df = number_counts.to_frame()
+    df = df[(df["Number"] >= 0) & (df["Number"] < cutoff)]
+    return df["Number"].values.astype("int64"), df["Count"].values.astype("int64")
+
+def bench_scan(config):
+    with StageTimer() as timer:
+        files, number_counts = scan_counts(config["data"], config["workers"])
+    tokens = int(number_counts.to_frame()["Count"].sum())
+    return timer, {"files": files, "tokens": tokens}
+
+def bench_export(config):
+    from gap import DEFAULT_CUTOFF
+    number_counts = scan_counts(config["data"], config["workers"])[1]
+    with tempfile.TemporaryDirectory() as output_dir:
+        with StageTimer() as timer:
+            df = number_counts.to_frame()
+            trimmed_df = df[(df["Number"] >= 0) & (df["Number"] < DEFAULT_CUTOFF)].copy()
+            df.to_csv(os.path.join(output_dir, "occurrence_counts.csv"), index=False)
+            trimmed_df.to_csv(os.path.join(output_dir, "occurrence_counts_trimmed.csv"), index=False)
+    return timer, {"rows": len(df)}
+
+def bench_classify(config):
+    from gap import DEFAULT_CUTOFF
+    from plot_counts import classify
+    numbers, _ = trimmed_numbers(config["data"], config["workers"], DEFAULT_CUTOFF)
+    with StageTimer() as timer:
+        classify(numbers)
+    return timer, {"numbers": len(numbers)}
+
+def bench_plot(config):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from gap import DEFAULT_CUTOFF
+    from plot_counts import classify, plot_density, plot_points
+    numbers, counts = trimmed_numbers(config["data"], config["workers"], DEFAULT_CUTOFF)
+    masks = classify(numbers)
+    with tempfile.TemporaryDirectory() as output_dir:
+        with StageTimer() as timer:
+            plt.figure(figsize=(10, 6))
+            if config["render"] == "density":
+                plot_density(numbers, counts, masks)
+            else:
+                plot_points(numbers, counts, masks)
+            plt.legend()
+            plt.savefig(os.path.join(output_dir, "plot.png"), dpi=300, bbox_inches="tight")
+            plt.close()
+    return timer, {"numbers": len(numbers), "render": config["render"]}
+
+def bench_midi(config):
+    from sonification import compute_gaps, create_synth_midi
+    # A random walk with small and occasional large steps, like a slowly growing sequence
+    rng = random.Random(config["seed"])
+    sequence = [0]
+    for _ in range(config["midi_terms"] - 1):
+        sequence.append(sequence[-1] + int(rng.paretovariate(1.5)))
+    # create_synth_midi prints the duration of every track, which is discarded
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), StageTimer() as timer:
+        gaps = np.minimum(compute_gaps(sequence), 10000)
+        midi = create_synth_midi(gaps)
+    return timer, {"terms": len(sequence), "midi_bytes": len(midi)}
+
+BENCHMARKS = {
+    "scan": bench_scan,
+    "export": bench_export,
+    "classify": bench_classify,
+    "plot": bench_plot,
+    "midi": bench_midi,
+}
+
+def run_stage(name, config):
+    """Run one stage in the current process, returns its metrics."""
+    timer, metrics = BENCHMARKS[name](config)
+    wall = timer.wall
+    metrics.update({"wall_s": round(wall, 6), "cpu_s": round(timer.cpu, 6)})
+    for unit in ("files", "tokens", "rows", "numbers", "terms"):
+        if unit in metrics:
+            metrics[f"{unit}_per_s"] = round(metrics[unit] / wall, 1) if wall > 0 else None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 if sys.platform == "darwin" else 1024
+    metrics["peak_rss_bytes"] = maxrss * scale
+    if config["workers"] > 1:
+        metrics["peak_rss_worker_bytes"] = children * scale
+    return metrics
+
+def run_isolated(name, config):
+    """Run one stage in a freshly spawned process."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_stage, name, config).result()
+
+def git_revision():
+    """Return the current git commit, or None outside of a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the stages of the oeistools scripts on a synthetic seq tree')
+    parser.add_argument('-n', '--files', type=int, help=f'Number of synthetic sequences (default: {DEFAULT_FILES})', default=DEFAULT_FILES)
+    parser.add_argument('--bignum-share', type=float, help=f'Share of bignum terms (default: {DEFAULT_BIGNUM_SHARE})', default=DEFAULT_BIGNUM_SHARE)
+    parser.add_argument('--data', type=str, help='Use this seq folder instead of generating one', default=None)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, help='Stages to run (default: all)', default=STAGES)
+    parser.add_argument('-w', '--workers', type=int, help='Worker processes of the scan (default: 1)', default=1)
+    parser.add_argument('--render', choices=['points', 'density'], help='Rendering of the plot stage (default: points)', default='points')
+    parser.add_argument('--midi-terms', type=int, help=f'Length of the sequence of the midi stage (default: {DEFAULT_MIDI_TERMS})', default=DEFAULT_MIDI_TERMS)
+    parser.add_argument('--seed', type=int, help='Random seed (default: 0)', default=0)
+    parser.add_argument('-o', '--output', type=str, help='Append the results as one JSON line to this file (default: print them)', default=None)
+    args = parser.parse_args()
+
+    config = {
+        "files": args.files,
+        "bignum_share": args.bignum_share,
+        "workers": args.workers,
+        "render": args.render,
+        "midi_terms": args.midi_terms,
+        "seed": args.seed,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.data:
+            config["data"] = args.data
+        else:
+            config["data"] = os.path.join(tmp, "seq")
+            start = time.perf_counter()
+            config["terms"] = generate_tree(config["data"], args.files, bignum_share=args.bignum_share, seed=args.seed)
+            print(f"Generated {args.files} sequences in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+        stages = {}
+        for name in args.stages:
+            stages[name] = run_isolated(name, config)
+            print(f"{name}: {stages[name]['wall_s']:.3f} s", file=sys.stderr)
+
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config if args.data else {key: value for key, value in config.items() if key != "data"},
+        "stages": stages,
+    }
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    else:
+        print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+import random
+import argparse
+
+"""
+Generator of synthetic seq trees for the benchmarks.
+
+Writes seq/Axxx/Axxxxxx.seq files that look like the oeisdata ones: an %I line, the terms
+split at commas over %S/%T/%U lines of at most 70 characters, and text lines (%N, %H, %F,
+%Y, %K, %O, %A) that contain numbers but are not counted by gap.py. As in oeisdata, terms
+that do not fit on the three data lines are dropped.
+
+The absolute values of the terms follow a Pareto distribution, so small numbers are
+frequent and large ones rare, like in the OEIS. A share of the terms is negative and a
+share are bignums with 20 to 60 digits, beyond int64. The output only depends on the seed.
+
+Example:
+    python -m benchmarks.synthetic /tmp/seq -n 20000 --bignum-share 0.05
+"""
+
+DEFAULT_FILES = 10000
+DEFAULT_TERMS = (10, 50)
+DEFAULT_ALPHA = 0.7
+DEFAULT_BIGNUM_SHARE = 0.02
+DEFAULT_NEGATIVE_SHARE = 0.05
+LINE_LENGTH = 70
+FILES_PER_FOLDER = 1000
+
+def random_term(rng, alpha, bignum_share, negative_share):
+    """Draw one term: a bignum, a negative number or a Pareto distributed non-negative number."""
+    r = rng.random()
+    if r < bignum_share:
+        digits = rng.randint(20, 60)
+        return rng.choice((-1, 1)) * rng.randint(10 ** (digits - 1), 10 ** digits - 1)
+    term = int(rng.paretovariate(alpha)) - 1
+    # Pareto variates can overflow int64 for small alpha, those are cut at 10^18
+    term = min(term, 10 ** 18)
+    return -term if r < bignum_share + negative_share else term
+
+def split_terms(terms, line_length=LINE_LENGTH, lines=3):
+    """Split the terms at commas into at most lines chunks of about line_length characters."""
+    chunks, current = [], ""
+    for term in map(str, terms):
+        if current and len(current) + len(term) + 1 > line_length:
+            chunks.append(current)
+            if len(chunks) == lines:
+                return chunks
+            current = ""
+        current += term + ","
+    if current:
+        chunks.append(current)
+    # The last line of the data does not end with a comma
+    chunks[-1] = chunks[-1].rstrip(",")
+    return chunks
+
+def seq_text(a_number, chunks):
+    """Return the contents of the .seq file of one synthetic sequence with the data lines chunks."""
+    length = sum(chunk.count(",") for chunk in chunks) + 1
+    lines = [f"%I {a_number} M{int(a_number[1:]) % 10000:04d}"]
+    lines += [f"%{tag} {a_number} {chunk}" for tag, chunk in zip("STU", chunks)]
+    lines += [
+        f"%N {a_number} Number of ways to tile a 2 X {length} board with 3 kinds of tiles.",
+        f"%H {a_number} Author, <a href=\"/{a_number}/b{a_number[1:]}.txt\">Table of n, a(n) for n = 0..{10 * length}</a>",
+        f"%F {a_number} a(n) = 2*a(n-1) + 3*a(n-2) - 1 for n > 1.",
+        f"%Y {a_number} Cf. A000045, A000108, A{(int(a_number[1:]) + 1) % 10 ** 6:06d}.",
+        f"%K {a_number} nonn,easy",
+        f"%O {a_number} 0,3",
+        f"%A {a_number} _Synthetic Author_, Jan 01 2000",
+    ]
+    return "\n".join(lines) + "\n"
+
+def generate_tree(root, files=DEFAULT_FILES, terms=DEFAULT_TERMS, alpha=DEFAULT_ALPHA,
+                  bignum_share=DEFAULT_BIGNUM_SHARE, negative_share=DEFAULT_NEGATIVE_SHARE, seed=0):
+    """Write a synthetic seq tree with files sequences below root, returns the number of terms written."""
+    rng = random.Random(seed)
+    total_terms = 0
+    for number in range(1, files + 1):
+        a_number = f"A{number:06d}"
+        folder = os.path.join(root, f"A{number // FILES_PER_FOLDER:03d}")
+        if number % FILES_PER_FOLDER == 0 or number == 1:
+            os.makedirs(folder, exist_ok=True)
+        sequence = [random_term(rng, alpha, bignum_share, negative_share)
+                    for _ in range(rng.randint(*terms))]
+        chunks = split_terms(sequence)
+        total_terms += sum(chunk.count(",") for chunk in chunks) + 1
+        with open(os.path.join(folder, f"{a_number}.seq"), "w") as f:
+            f.write(seq_text(a_number, chunks))
+    return total_terms
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic seq tree for the benchmarks')
+    parser.add_argument('root', help='Output folder, e.g. /tmp/seq')
+    parser.add_argument('-n', '--files', type=int, help=f'Number of sequences (default: {DEFAULT_FILES})', default=DEFAULT_FILES)
+    parser.add_argument('--terms', type=int, nargs=2, metavar=('MIN', 'MAX'), help=f'Number of terms per sequence (default: {DEFAULT_TERMS[0]} {DEFAULT_TERMS[1]})', default=DEFAULT_TERMS)
+    parser.add_argument('--alpha', type=float, help=f'Pareto shape of the term sizes, smaller means larger terms (default: {DEFAULT_ALPHA})', default=DEFAULT_ALPHA)
+    parser.add_argument('--bignum-share', type=float, help=f'Share of terms with 20 to 60 digits (default: {DEFAULT_BIGNUM_SHARE})', default=DEFAULT_BIGNUM_SHARE)
+    parser.add_argument('--negative-share', type=float, help=f'Share of negative terms (default: {DEFAULT_NEGATIVE_SHARE})', default=DEFAULT_NEGATIVE_SHARE)
+    parser.add_argument('--seed', type=int, help='Random seed (default: 0)', default=0)
+    args = parser.parse_args()
+
+    total_terms = generate_tree(args.root, args.files, tuple(args.terms), args.alpha,
+                                args.bignum_share, args.negative_share, args.seed)
+    print(f"Wrote {args.files} sequences with {total_terms} terms to {args.root}")
+
+if __name__ == "__main__":
+    main()
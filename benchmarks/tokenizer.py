@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import re
+import time
+import argparse
+from collections import Counter
+
+import gap
+from corpus import list_seq_files
+
+"""
+Micro-benchmark of the number extraction in gap.py.
+
+Compares the byte-level tokenizer of gap.py with the original path that decodes every
+file as UTF-8, checks each line with startswith, runs a str regex and calls int() on every
+match. Both paths must produce the same counts.
+
+Run from the repository root:
+    python -m benchmarks.tokenizer ./seq
+"""
+
+# Original regular expression from gap.py, working on decoded text
+text_number_pattern = re.compile(r"-?\d+")
+
+def regex_count_file(file_path, counts):
+    """The original extraction: text decode + str regex + int() per token."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(("%S", "%T", "%U")):
+                numbers = text_number_pattern.findall(line)
+                counts.update(map(int, numbers))
+
+def run_regex(all_files):
+    counts = Counter()
+    for file_path in all_files:
+        regex_count_file(file_path, counts)
+    return counts
+
+def run_bytes(all_files):
+    token_counts = Counter()
+    for file_path in all_files:
+        gap.count_file(file_path, token_counts)
+    return gap.to_int_counts(token_counts)
+
+def best_time(func, all_files, repeat):
+    """Return the best wall time of repeat runs and the result of the last one."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(all_files)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tokenizer of gap.py against the original regex path')
+    parser.add_argument('data_path', nargs='?', default=gap.DATA_PATH, help='Path of the seq folder')
+    parser.add_argument('-n', '--files', type=int, default=None, help='Only use the first N files')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of timed runs per path')
+    args = parser.parse_args()
+
+    all_files = sorted(list_seq_files(args.data_path))[:args.files]
+    regex_time, regex_counts = best_time(run_regex, all_files, args.repeat)
+    bytes_time, bytes_counts = best_time(run_bytes, all_files, args.repeat)
+
+    if regex_counts != bytes_counts:
+        raise SystemExit("Counts differ between the regex and the bytes tokenizer")
+    tokens = sum(regex_counts.values())
+    print(f"{len(all_files)} files, {tokens} tokens, {len(regex_counts)} distinct numbers")
+    print(f"regex path: {regex_time:.3f} s ({tokens / regex_time:,.0f} tokens/s)")
+    print(f"bytes path: {bytes_time:.3f} s ({tokens / bytes_time:,.0f} tokens/s)")
+    print(f"speedup:    {regex_time / bytes_time:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import os
+import re
+import tarfile
+import zipfile
+import zlib
+import threading
+import subprocess
+
+"""
+Sources of the .seq files for gap.py.
+
+- DirectorySource: an extracted seq folder. It yields the file paths, the files are read
+  by whoever scans them (e.g. a worker process).
+- TarSource: a .tar/.tar.gz/.tgz/.tar.bz2/.tar.xz archive, streamed member by member.
+- ZipSource: a .zip archive, read entry by entry.
+- GitSource: a tree of a git repository, read from its object store with git cat-file.
+
+The archive and git sources yield (name, contents) pairs, so a scan does one large
+sequential read instead of opening and closing every file. The total attribute is the
+number of files, or None if it is not known in advance (tar streams).
+
+ShardSource restricts any source to a deterministic, hash-partitioned subset of the files
+for the distributed mode of gap.py (--shard).
+
+seq_path and read_terms look up single sequences in a seq folder, e.g. for sonification.py.
+"""
+
+# File names of sequences, e.g. seq/A000/A000045.seq
+seq_name_pattern = re.compile(r"(?:^|/)A\d+\.seq$")
+
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+def list_seq_files(data_path):
+    """Return the paths of all .seq files in the OEIS data folder."""
+    all_folders = [os.path.join(data_path, folder) for folder in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, folder))]
+    return [os.path.join(folder, filename) for folder in all_folders for filename in os.listdir(folder) if filename.endswith(".seq")]
+
+def seq_path(data_path, seq_id):
+    """Return the path of the .seq file of a sequence id in a seq folder, e.g. seq/A000/A000045.seq for 45."""
+    return os.path.join(data_path, f"A{seq_id // 1000:03d}", f"A{seq_id:06d}.seq")
+
+def read_terms(file_path):
+    """Return the terms of a sequence as ints, from the %S, %T and %U lines of its .seq file."""
+    data = []
+    with open(file_path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(("%S", "%T", "%U")):
+                # "%S A000045 0,1,1,2,...", the data lines are split after a comma
+                fields = line.split(None, 2)
+                if len(fields) == 3:
+                    data.append(fields[2].strip())
+    return [int(term) for term in ",".join(data).split(",") if term]
+
+class DirectorySource:
+    """The .seq files of an extracted seq folder, yielded as file paths."""
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.files = list_seq_files(data_path)
+        self.total = len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+class TarSource:
+    """The .seq members of a (compressed) tar archive, streamed as (name, contents) pairs."""
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.total = None  # Unknown without reading the whole stream
+
+    def __iter__(self):
+        with tarfile.open(self.archive_path, mode="r|*") as archive:
+            for member in archive:
+                if member.isfile() and seq_name_pattern.search(member.name):
+                    yield member.name, archive.extractfile(member).read()
+
+class ZipSource:
+    """The .seq entries of a zip archive as (name, contents) pairs."""
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        with zipfile.ZipFile(archive_path) as archive:
+            self.names = [info.filename for info in archive.infolist() if seq_name_pattern.search(info.filename)]
+        self.total = len(self.names)
+
+    def __iter__(self):
+        with zipfile.ZipFile(self.archive_path) as archive:
+            for name in self.names:
+                yield name, archive.read(name)
+
+class GitSource:
+    """The .seq blobs below subdir in a tree of a git repository, as (name, contents) pairs."""
+
+    def __init__(self, repo_path, rev="HEAD", subdir="seq"):
+        self.repo_path = repo_path
+        listing = subprocess.run(["git", "-C", repo_path, "ls-tree", "-r", "-z", rev, "--", subdir],
+                                 capture_output=True, check=True).stdout
+        self.blobs = []
+        for record in listing.split(b"\0"):
+            if not record:
+                continue
+            meta, name = record.split(b"\t", 1)
+            _, kind, sha = meta.split()
+            name = name.decode()
+            if kind == b"blob" and seq_name_pattern.search(name):
+                self.blobs.append((name, sha))
+        self.total = len(self.blobs)
+
+    def __iter__(self):
+        process = subprocess.Popen(["git", "-C", self.repo_path, "cat-file", "--batch"],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def request_blobs():
+            try:
+                for _, sha in self.blobs:
+                    process.stdin.write(sha + b"\n")
+                process.stdin.close()
+            except (BrokenPipeError, ValueError):
+                pass  # The reader stopped early
+
+        # Requests are written from a thread, so that neither side blocks on a full pipe
+        writer = threading.Thread(target=request_blobs, daemon=True)
+        writer.start()
+        try:
+            for name, sha in self.blobs:
+                size = int(process.stdout.readline().split()[2])
+                data = process.stdout.read(size)
+                process.stdout.read(1)  # Newline after the contents
+                yield name, data
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            writer.join()
+            process.wait()
+
+def shard_of(name, shard_count):
+    """Return the shard of a seq file, a deterministic hash of its file name."""
+    return zlib.crc32(os.path.basename(name).encode()) % shard_count
+
+class ShardSource:
+    """
+    The seq files of another source that belong to shard shard_index of shard_count.
+
+    Sources that list their files in advance (folder, zip, git) have the list filtered,
+    so files of other shards are never read. A tar stream is filtered while streaming.
+    """
+
+    def __init__(self, source, shard_index, shard_count):
+        self.source = source
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+        def in_shard(name):
+            return shard_of(name, shard_count) == shard_index
+
+        if isinstance(source, DirectorySource):
+            source.files = [name for name in source.files if in_shard(name)]
+            source.total = len(source.files)
+        elif isinstance(source, ZipSource):
+            source.names = [name for name in source.names if in_shard(name)]
+            source.total = len(source.names)
+        elif isinstance(source, GitSource):
+            source.blobs = [(name, sha) for name, sha in source.blobs if in_shard(name)]
+            source.total = len(source.blobs)
+        self.total = source.total
+        self.in_shard = in_shard
+
+    def __iter__(self):
+        if self.total is not None:
+            return iter(self.source)
+        return (entry for entry in self.source if self.in_shard(entry[0]))
+
+def open_source(path, git_rev=None):
+    """Return the source for a seq folder, an archive, or (with git_rev) a git repository."""
+    if git_rev is not None:
+        return GitSource(path, git_rev)
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if path.endswith(".zip"):
+        return ZipSource(path)
+    if path.endswith(TAR_EXTENSIONS):
+        return TarSource(path)
+    raise ValueError(f"Unknown corpus source {path}: expected a directory, a tar or a zip archive")
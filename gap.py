@@ -2,11 +2,22 @@
 
 import os
 import re
-import pandas as pd
+import mmap
+import time
+import hashlib
+import pickle
+import numpy as np
 from collections import Counter
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
 from tqdm import tqdm  # Progress bar
 import argparse
 
+from aggregators import (AGGREGATORS, DEFAULT_DENSE_LIMIT, CompactCounter, GapTracker, IndexBuilder,
+                         OccurrenceCounts, to_int_counts)
+from corpus import DirectorySource, ShardSource, open_source
+import profiling
+
 """
 This script processes the OEIS (Online Encyclopedia of Integer Sequences) data to analyze the occurrences of each number.
 It traverses through sequence files, extracts numbers, and counts their occurrences.
@@ -17,75 +28,457 @@ The script outputs statistics including:
 
 The results are saved to a CSV file, and if a cutoff is specified, a trimmed version of the data is also saved.
 The script is designed to analyze the numbers that appear in the three lines printed on the OEIS web pages.
+
+Every file is read and tokenized once. The tokens of each %S, %T and %U line are fed to a
+list of aggregators (see aggregators.py): the occurrence counts, and optionally the inverted
+index (--index) and further statistics (--stats), so N statistics cost one pass.
+
+With --workers N the files are split into chunks that are processed in N worker processes,
+each with its own copies of the aggregators. The copies are merged at the end, so the
+output is identical to a serial run.
+
+The files are read from an extracted seq folder (the default), from a tar or zip archive
+(--source), or from a git repository's object store (--source REPO --git REV), see corpus.py.
+
+With --cache PATH the contribution of every file is stored on disk together with its mtime,
+size and content hash. Later runs only re-parse new or changed files, subtract deleted ones
+and update the global counts by the difference. --full rebuilds the cache from scratch.
+
+Files are tokenized on raw bytes, large files are memory-mapped. Numbers are counted as
+byte tokens and only the distinct tokens are converted to int when the counts are aggregated.
+
+The counts are kept in a CompactCounter: dense NumPy arrays for the values in
+[0, --dense-limit) and for small negative values, and a dict for everything else.
+
+The smallest non-negative integers that do not occur are tracked during the scan with a
+presence bitmap and a pointer to its first zero bit. --gaps K reports the first K of them.
+
+With --format npy (or both) the counts are also written as a memory-mappable pair of int64
+.npy files, <base>.numbers.npy and <base>.counts.npy. Numbers outside of int64 are written
+to <base>.bignums.csv. plot_counts.py reads either format.
+
+With --index DIR the same pass also builds an inverted index from each number to the
+sequences (A-numbers) that contain it. It is stored as sorted keys, byte offsets and
+delta-encoded varint postings in .npy files and is queried with seqindex.py.
+
+With --profile PATH (or OEISTOOLS_PROFILE=PATH) the time of every phase, from listing the
+files over reading, tokenizing and counting to writing the CSV, the bytes and tokens read,
+the slowest files and the peak memory are written to PATH at exit, see profiling.py.
 """
 
 DEFAULT_CUTOFF = 10000
 csv_path = "occurrence_counts.csv"
 trimmed_csv_path = "occurrence_counts_trimmed.csv"
+npy_base = "occurrence_counts"
+trimmed_npy_base = "occurrence_counts_trimmed"
 
 # Path to the OEIS data folder
 DATA_PATH = "./seq"
 
+# Number of files handed to a worker process at once
+CHUNK_SIZE = 500
+
+# Files up to this size are read at once, larger ones are memory-mapped. For the typical
+# .seq file of a few KB the mmap/munmap calls cost more than they save.
+MMAP_THRESHOLD = 64 * 1024
+
+# Format version of the incremental cache, bump when its layout changes
+CACHE_VERSION = 2
+
+# Prefixes of the lines whose numbers are counted
+DATA_LINE_TYPES = (b"%S", b"%T", b"%U")
+
 # Regular expression to extract integers (positive and negative)
-number_pattern = re.compile(r"-?\d+")
+number_pattern = re.compile(rb"-?\d+")
+
+def save_npy(df, base_path):
+    """
+    Save a sorted Number/Count DataFrame as <base_path>.numbers.npy and <base_path>.counts.npy.
+
+    Numbers that do not fit into int64 go to <base_path>.bignums.csv instead.
+    Returns the list of written files.
+    """
+    numbers = df["Number"].values
+    counts = df["Count"].values
+    written = []
+    if numbers.dtype == object:
+        fits = np.fromiter((-2**63 <= n < 2**63 for n in numbers), dtype=bool, count=len(numbers))
+        if not fits.all():
+            df[~fits].to_csv(f"{base_path}.bignums.csv", index=False)
+            written.append(f"{base_path}.bignums.csv")
+        numbers = numbers[fits].astype(np.int64)
+        counts = counts[fits]
+    np.save(f"{base_path}.numbers.npy", numbers.astype(np.int64))
+    np.save(f"{base_path}.counts.npy", counts.astype(np.int64))
+    return [f"{base_path}.numbers.npy", f"{base_path}.counts.npy"] + written
+
+def seq_id(file_path):
+    """Return the sequence id of a .seq file, e.g. 45 for .../A000045.seq."""
+    return int(os.path.basename(file_path)[1:-len(".seq")])
+
+def data_lines(buffer):
+    """Return the %S, %T and %U lines of buffer (bytes or an mmap)."""
+    # Splitting at line breaks and comparing the prefix is faster than a MULTILINE regex
+    # that is tried at every byte. An mmap has no splitlines(), so it is copied once.
+    if not isinstance(buffer, bytes):
+        buffer = buffer[:]
+    return [line for line in buffer.splitlines() if line[:2] in DATA_LINE_TYPES]
+
+def iter_lines(buffer):
+    """Yield the line type ("S", "T" or "U") and the number tokens of the %S, %T and %U lines in buffer."""
+    findall = number_pattern.findall
+    for line in data_lines(buffer):
+        yield chr(line[1]), findall(line)
+
+def count_buffer(buffer, counts):
+    """Add the number tokens of the %S, %T and %U lines in buffer to counts, keyed by bytes."""
+    findall = number_pattern.findall
+    for line in data_lines(buffer):
+        counts.update(findall(line))
+
+def read_file(file_path, func):
+    """Call func with the contents of a file, memory-mapped if it is larger than MMAP_THRESHOLD."""
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= MMAP_THRESHOLD:
+            return func(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return func(buffer)
+
+def count_file(file_path, counts):
+    """Add the number tokens of the %S, %T and %U lines of one file to counts."""
+    read_file(file_path, lambda buffer: count_buffer(buffer, counts))
+
+def scan_entry(entry, aggregators):
+    """
+    Feed the %S, %T and %U lines of one seq file to the aggregators.
+
+    entry is a file path or a (name, contents) pair, as yielded by the sources in corpus.py.
+    """
+    if profiling.profile.enabled:
+        return profile_entry(entry, aggregators, profiling.profile)
+    name = entry if isinstance(entry, str) else entry[0]
+    file_seq_id = seq_id(name)
+
+    def feed(buffer):
+        for line_type, values in iter_lines(buffer):
+            for aggregator in aggregators:
+                aggregator.update(file_seq_id, line_type, values)
+
+    if isinstance(entry, str):
+        read_file(entry, feed)
+    else:
+        feed(entry[1])
+    for aggregator in aggregators:
+        aggregator.end_file(file_seq_id)
 
-# Dictionary to count occurrences
-number_counts = Counter()
+def profile_entry(entry, aggregators, profile):
+    """scan_entry, recording the time of reading, tokenizing and aggregating in profile."""
+    start = time.perf_counter()
+    with profile.phase("read"):
+        name, data = (entry, read_file(entry, bytes)) if isinstance(entry, str) else entry
+    with profile.phase("tokenize"):
+        lines = list(iter_lines(data))
+    with profile.phase("aggregate"):
+        file_seq_id = seq_id(name)
+        for line_type, values in lines:
+            for aggregator in aggregators:
+                aggregator.update(file_seq_id, line_type, values)
+        for aggregator in aggregators:
+            aggregator.end_file(file_seq_id)
+    profile.add("files")
+    profile.add("bytes_read", len(data))
+    profile.add("lines", len(lines))
+    profile.add("tokens", sum(len(values) for _, values in lines))
+    profile.add_file(name, time.perf_counter() - start, len(data))
 
-# Argument parsing, looking for cutoff value.
-parser = argparse.ArgumentParser(description='Process OEIS sequence and find gaps')
-parser.add_argument('-c', '--cutoff', type=int, help='Optional cutoff value for trimmed output', default=None)
-args = parser.parse_args()
+def scan_chunk(entries, aggregators, profile=None):
+    """
+    Feed a list of seq files to the aggregators. This is the unit of work of a worker process.
 
-# Get total number of files for progress tracking
-all_folders = [os.path.join(DATA_PATH, folder) for folder in os.listdir(DATA_PATH) if os.path.isdir(os.path.join(DATA_PATH, folder))]
-all_files = [os.path.join(folder, filename) for folder in all_folders for filename in os.listdir(folder) if filename.endswith(".seq")]
-total_files = len(all_files)
+    Returns the aggregators and the profile, which collects the timings of the chunk if given.
+    """
+    if profile is not None:
+        profiling.activate(profile)
+    for entry in entries:
+        scan_entry(entry, aggregators)
+    return aggregators, profile
 
-# Traverse OEIS directory with progress bar
-with tqdm(total=total_files, desc="Processing Sequence Files", unit="files") as pbar:
+def iter_chunks(items, chunk_size):
+    """Split an iterable into lists of chunk_size items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def map_chunks(func, items, workers=1, chunk_size=CHUNK_SIZE):
+    """
+    Apply func to chunks of items, serially or with a pool of worker processes.
+
+    Yields (result, chunk length) pairs in completion order. In serial mode every
+    chunk holds a single item, so a progress bar advances after each file. items may
+    be a stream; at most 2 * workers chunks are read ahead of the workers.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func([item]), 1
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for chunk in iter_chunks(items, chunk_size):
+                pending[executor.submit(func, chunk)] = len(chunk)
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result(), pending.pop(future)
+            for future in as_completed(pending):
+                yield future.result(), pending[future]
+
+def run_pipeline(source, aggregators, workers=1, chunk_size=CHUNK_SIZE):
+    """
+    Feed all seq files of a source to the aggregators in one pass, serially or with a pool of worker processes.
+
+    Worker processes get empty copies of the aggregators (from spawn()) for every chunk,
+    which are merged into the given aggregators as the chunks complete.
+    """
+    with tqdm(total=getattr(source, "total", None), desc="Processing Sequence Files", unit="files") as pbar:
+        if workers <= 1:
+            for entry in source:
+                scan_entry(entry, aggregators)
+                pbar.update(1)  # Update progress bar after each file
+        else:
+            profile = profiling.profile
+            worker = partial(scan_chunk, aggregators=[aggregator.spawn() for aggregator in aggregators],
+                             profile=profile.spawn() if profile.enabled else None)
+            for (partials, chunk_profile), n in map_chunks(worker, source, workers, chunk_size):
+                with profile.phase("merge"):
+                    for aggregator, partial_aggregator in zip(aggregators, partials):
+                        aggregator.merge(partial_aggregator)
+                profile.merge(chunk_profile)
+                pbar.update(n)
+    with profiling.profile.phase("finish"):
+        for aggregator in aggregators:
+            aggregator.finish()
+
+def stat_key(file_path):
+    """Return the (mtime, size) pair used to detect changed files."""
+    st = os.stat(file_path)
+    return st.st_mtime_ns, st.st_size
+
+def scan_files(items):
+    """
+    Read a list of (file_path, cached digest) pairs and count each file separately.
+
+    Returns a list of (file_path, mtime, size, digest, counts) tuples. If the content hash
+    of a file equals its cached digest the file is not parsed and counts is None.
+    """
+    results = []
+    for file_path, cached_digest in items:
+        mtime, size = stat_key(file_path)
+        with open(file_path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        counts = None
+        if digest != cached_digest:
+            token_counts = Counter()
+            count_buffer(data, token_counts)
+            counts = to_int_counts(token_counts)
+        results.append((file_path, mtime, size, digest, counts))
+    return results
+
+def empty_cache(dense_limit=DEFAULT_DENSE_LIMIT):
+    """Return a cache without any files."""
+    return {"version": CACHE_VERSION, "files": {}, "counts": CompactCounter(dense_limit)}
+
+def load_cache(cache_path, dense_limit=DEFAULT_DENSE_LIMIT):
+    """Load the incremental cache, or return an empty one if it is missing or outdated."""
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+        if cache.get("version") == CACHE_VERSION:
+            return cache
+        print(f"Cache {cache_path} has an outdated format, rebuilding it.")
+    return empty_cache(dense_limit)
+
+def save_cache(cache, cache_path):
+    """Write the incremental cache atomically."""
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+
+def count_incremental(all_files, cache, workers=1, chunk_size=CHUNK_SIZE):
+    """
+    Bring the cached counts up to date with the files on disk.
+
+    Deleted files are subtracted, new and changed files are (re-)parsed and their
+    difference is applied to the global counts. Returns the updated counts.
+    """
+    files = cache["files"]
+    number_counts = cache["counts"]
+
+    # Subtract files that no longer exist
+    current_files = set(all_files)
+    deleted = [file_path for file_path in files if file_path not in current_files]
+    for file_path in deleted:
+        number_counts.subtract(files.pop(file_path)[3])
+
+    # Find new files and files whose mtime or size changed
+    todo = []
     for file_path in all_files:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                # Only process lines starting with %S, %T, or %U
-                if line.startswith(("%S", "%T", "%U")):
-                    numbers = number_pattern.findall(line)
-                    number_counts.update(map(int, numbers))
-        pbar.update(1)  # Update progress bar after each file
-
-# Convert to DataFrame
-df = pd.DataFrame(number_counts.items(), columns=["Number", "Count"])
-df.sort_values(by="Number", inplace=True)
-
-# Save full counts to CSV
-df.to_csv(csv_path, index=False)
-
-# Save trimmed counts
-cutoff = args.cutoff if args.cutoff is not None else DEFAULT_CUTOFF
-trimmed_df = df[
-    (df["Number"] >= 0) & 
-    (df["Number"] < cutoff)
-].copy()
-trimmed_df.to_csv(trimmed_csv_path, index=False)
-
-# Get sorted array of numbers once
-numbers = df["Number"].values  # numbers are already sorted from earlier
-numbers = numbers[numbers >= 0]  # filter to non-negative numbers only
-
-# Find first gap in sequence
-missing_number = 0
-for num in numbers:
-    if num > missing_number:
-        break
-    missing_number = num + 1
-
-# Print some stats:
-largest_number = df['Number'].max()
-smallest_number = df['Number'].min()
-number_of_ones = number_counts[1]
-print(f"Largest number occurring: {largest_number}")
-print(f"Smallest number occurring (including negatives): {smallest_number}")
-print(f"Number of ones occurring: {number_of_ones}")
-print(f"Smallest non-negative integer not in the OEIS: {missing_number}")
-print(f"Full count statistics saved to {csv_path}.")
-print(f"Trimmed count statistics saved to {trimmed_csv_path}.")
\ No newline at end of file
+        entry = files.get(file_path)
+        if entry is None:
+            todo.append((file_path, None))
+        elif stat_key(file_path) != entry[:2]:
+            todo.append((file_path, entry[2]))
+    print(f"Cache: {len(all_files) - len(todo)} unchanged, {len(todo)} new or changed, "
+          f"{len(deleted)} deleted files.")
+
+    with tqdm(total=len(todo), desc="Processing Sequence Files", unit="files") as pbar:
+        for results, n in map_chunks(scan_files, todo, workers, chunk_size):
+            for file_path, mtime, size, digest, file_counts in results:
+                if file_counts is None:
+                    # Only touched, the content is the same
+                    files[file_path] = (mtime, size, digest, files[file_path][3])
+                    continue
+                if file_path in files:
+                    number_counts.subtract(files[file_path][3])
+                number_counts.update(file_counts)
+                files[file_path] = (mtime, size, digest, file_counts)
+            pbar.update(n)
+    return number_counts
+
+def shard_spec(text):
+    """Parse a shard given as I/N, e.g. 0/4 for the first of four shards."""
+    try:
+        index, count = map(int, text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/N, got {text}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {count}), got {index}")
+    return index, count
+
+def partial_path(shard_index, shard_count):
+    """Default name of the partial counts of a shard."""
+    return f"partial_counts_{shard_index}_of_{shard_count}.csv"
+
+def main():
+    # Argument parsing, looking for cutoff value.
+    parser = argparse.ArgumentParser(description='Process OEIS sequence and find gaps')
+    parser.add_argument('-c', '--cutoff', type=int, help='Optional cutoff value for trimmed output', default=None)
+    parser.add_argument('-s', '--source', type=str, help=f'seq folder, tar/zip archive or git repository (default: {DATA_PATH})', default=DATA_PATH)
+    parser.add_argument('--git', type=str, metavar='REV', help='Read the seq folder of revision REV from the git repository given by --source', default=None)
+    parser.add_argument('-w', '--workers', type=int, help='Number of worker processes (default: 1, serial)', default=1)
+    parser.add_argument('--cache', type=str, help='Path of an incremental cache; only new or changed files are re-parsed', default=None)
+    parser.add_argument('--full', action='store_true', help='Ignore the existing cache and rebuild it from scratch')
+    parser.add_argument('--gaps', type=int, help='Report the first K non-negative integers not in the OEIS (default: 1)', default=1)
+    parser.add_argument('--format', choices=['csv', 'npy', 'both'], help='Output format of the counts (default: csv)', default='csv')
+    parser.add_argument('--stats', nargs='+', choices=sorted(AGGREGATORS), help='Additional statistics computed in the same pass', default=[])
+    parser.add_argument('--index', type=str, help='Also build an inverted index from number to sequences in this directory', default=None)
+    parser.add_argument('--shard', type=shard_spec, metavar='I/N', help='Only count shard I of N and write its sorted partial counts, see merge_counts.py', default=None)
+    parser.add_argument('--partial', type=str, help='Output of the partial counts with --shard (default: partial_counts_I_of_N.csv)', default=None)
+    parser.add_argument('--profile', type=str, metavar='PATH', help=f'Write per-phase timings and counters to PATH at exit, .prom for a Prometheus textfile, else JSON (or set {profiling.PROFILE_ENV})', default=None)
+    parser.add_argument('--profile-files', type=int, metavar='N', help=f'Number of slowest files in the profile (default: {profiling.DEFAULT_SLOWEST})', default=profiling.DEFAULT_SLOWEST)
+    parser.add_argument('--dense-limit', type=int, help=f'Count values below this limit in a dense array (default: {DEFAULT_DENSE_LIMIT})', default=DEFAULT_DENSE_LIMIT)
+    args = parser.parse_args()
+    profile = profiling.setup(args.profile, "gap.py", args.profile_files)
+    if args.cache and args.stats:
+        parser.error("--stats needs all files and cannot be combined with --cache")
+    if args.shard and (args.cache or args.stats or args.index):
+        parser.error("--shard only writes partial counts and cannot be combined with --cache, --stats or --index")
+
+    # Open the corpus, for a folder this lists all files for progress tracking
+    with profile.phase("list files"):
+        source = open_source(args.source, args.git)
+    if args.cache and not isinstance(source, DirectorySource):
+        parser.error("--cache needs an extracted seq folder as --source")
+    if args.shard:
+        with profile.phase("list files"):
+            source = ShardSource(source, *args.shard)
+
+    # Traverse OEIS directory with progress bar
+    index_builder = IndexBuilder(args.index) if args.index else None
+    statistics = [AGGREGATORS[name]() for name in args.stats]
+    if args.cache:
+        cache = empty_cache(args.dense_limit) if args.full else load_cache(args.cache, args.dense_limit)
+        with profile.phase("scan"):
+            number_counts = count_incremental(source.files, cache, workers=args.workers)
+        with profile.phase("write cache"):
+            save_cache(cache, args.cache)
+        # Counts can drop to zero in an incremental run, so the bitmap is rebuilt from them
+        with profile.phase("gaps"):
+            gap_tracker = GapTracker.from_counts(number_counts)
+        if index_builder is not None:
+            # The cached per-file counts hold everything the index needs
+            with profile.phase("index"):
+                for file_path, entry in cache["files"].items():
+                    index_builder.add_counts(seq_id(file_path), entry[3])
+    else:
+        occurrences = OccurrenceCounts(args.dense_limit)
+        aggregators = [occurrences] + ([index_builder] if index_builder is not None else []) + statistics
+        with profile.phase("scan"):
+            run_pipeline(source, aggregators, workers=args.workers)
+        number_counts = occurrences.counts
+        gap_tracker = occurrences.gap_tracker
+    with profile.phase("report statistics"):
+        for aggregator in ([index_builder] if index_builder is not None else []) + statistics:
+            aggregator.report()
+
+    # Convert to DataFrame, already sorted by number
+    with profile.phase("dataframe"):
+        df = number_counts.to_frame()
+
+    if args.shard:
+        # A shard only writes its sorted counts, merge_counts.py combines the shards
+        output = args.partial or partial_path(*args.shard)
+        with profile.phase("write csv"):
+            df.to_csv(output, index=False)
+        print(f"Partial counts of shard {args.shard[0]}/{args.shard[1]} ({len(df)} numbers) saved to {output}.")
+        return
+
+    # Trimmed counts
+    cutoff = args.cutoff if args.cutoff is not None else DEFAULT_CUTOFF
+    with profile.phase("dataframe"):
+        trimmed_df = df[
+            (df["Number"] >= 0) &
+            (df["Number"] < cutoff)
+        ].copy()
+
+    # Save full and trimmed counts
+    saved = []
+    if args.format in ('csv', 'both'):
+        with profile.phase("write csv"):
+            df.to_csv(csv_path, index=False)
+            trimmed_df.to_csv(trimmed_csv_path, index=False)
+        saved.append((csv_path, trimmed_csv_path))
+    if args.format in ('npy', 'both'):
+        saved.append((f"{npy_base}.numbers.npy", f"{trimmed_npy_base}.numbers.npy"))
+        with profile.phase("write npy"):
+            save_npy(df, npy_base)
+            save_npy(trimmed_df, trimmed_npy_base)
+
+    # First gaps, found during the scan
+    missing_numbers = gap_tracker.first_gaps(args.gaps)
+
+    # Print some stats:
+    largest_number = df['Number'].max()
+    smallest_number = df['Number'].min()
+    number_of_ones = number_counts[1]
+    print(f"Largest number occurring: {largest_number}")
+    print(f"Smallest number occurring (including negatives): {smallest_number}")
+    print(f"Number of ones occurring: {number_of_ones}")
+    if missing_numbers:
+        print(f"Smallest non-negative integer not in the OEIS: {missing_numbers[0]}")
+    if len(missing_numbers) < args.gaps:
+        print(f"All integers below {gap_tracker.max_bits} occur, only {len(missing_numbers)} gaps found.")
+    if args.gaps > 1:
+        print(f"First {len(missing_numbers)} non-negative integers not in the OEIS: {', '.join(map(str, missing_numbers))}")
+    for full_path, trimmed_path in saved:
+        print(f"Full count statistics saved to {full_path}.")
+        print(f"Trimmed count statistics saved to {trimmed_path}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+import csv
+import heapq
+import argparse
+from itertools import groupby
+from operator import itemgetter
+
+from gap import DEFAULT_CUTOFF, csv_path, trimmed_csv_path
+
+"""
+This script merges the partial counts written by gap.py --shard I/N into the full and
+trimmed occurrence counts, and reports the same statistics as gap.py.
+
+The partial files are sorted by number, so they are combined with a streaming k-way merge:
+only one row per input file is held in memory, and the output is written while merging.
+
+Example:
+    python gap.py --shard 0/2 && python gap.py --shard 1/2
+    python merge_counts.py partial_counts_0_of_2.csv partial_counts_1_of_2.csv
+"""
+
+def read_partial(path):
+    """Yield the (number, count) rows of a partial count file, sorted by number."""
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        next(reader)  # Header
+        for number, count in reader:
+            yield int(number), int(count)
+
+def merge_partials(paths):
+    """Yield (number, total count) over all partial files, sorted by number."""
+    merged = heapq.merge(*(read_partial(path) for path in paths), key=itemgetter(0))
+    for number, rows in groupby(merged, key=itemgetter(0)):
+        yield number, sum(count for _, count in rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the partial counts of gap.py --shard into the occurrence counts')
+    parser.add_argument('partials', nargs='+', help='Partial count files written by gap.py --shard')
+    parser.add_argument('-c', '--cutoff', type=int, help='Optional cutoff value for trimmed output', default=None)
+    parser.add_argument('--gaps', type=int, help='Report the first K non-negative integers not in the OEIS (default: 1)', default=1)
+    args = parser.parse_args()
+
+    cutoff = args.cutoff if args.cutoff is not None else DEFAULT_CUTOFF
+    smallest_number = largest_number = None
+    number_of_ones = 0
+    missing_numbers = []
+    expected = 0  # Smallest non-negative integer not seen yet
+    with open(csv_path, "w", newline="") as full, open(trimmed_csv_path, "w", newline="") as trimmed:
+        full.write("Number,Count\n")
+        trimmed.write("Number,Count\n")
+        for number, count in merge_partials(args.partials):
+            row = f"{number},{count}\n"
+            full.write(row)
+            if 0 <= number < cutoff:
+                trimmed.write(row)
+            if smallest_number is None:
+                smallest_number = number
+            largest_number = number
+            if number == 1:
+                number_of_ones = count
+            # The numbers arrive in order, so every skipped non-negative integer is a gap
+            while expected < number and len(missing_numbers) < args.gaps:
+                missing_numbers.append(expected)
+                expected += 1
+            expected = max(expected, number + 1)
+    while len(missing_numbers) < args.gaps:
+        missing_numbers.append(expected)
+        expected += 1
+
+    print(f"Largest number occurring: {largest_number}")
+    print(f"Smallest number occurring (including negatives): {smallest_number}")
+    print(f"Number of ones occurring: {number_of_ones}")
+    if missing_numbers:
+        print(f"Smallest non-negative integer not in the OEIS: {missing_numbers[0]}")
+    if args.gaps > 1:
+        print(f"First {len(missing_numbers)} non-negative integers not in the OEIS: {', '.join(map(str, missing_numbers))}")
+    print(f"Full count statistics saved to {csv_path}.")
+    print(f"Trimmed count statistics saved to {trimmed_csv_path}.")
+
+if __name__ == "__main__":
+    main()
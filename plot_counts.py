@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
+import argparse
+from math import isqrt
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgb
+from matplotlib.ticker import FuncFormatter, MaxNLocator
 import numpy as np
-from sympy.ntheory import isprime
 from scipy import stats
 
+import profiling
+
 """
 This script plots the occurrence counts of numbers in the OEIS (Online Encyclopedia of Integer Sequences) data.
 It reads a trimmed CSV file containing these counts and performs statistical analysis and visualization.
@@ -19,76 +24,234 @@ Following the orginal coloring in Giuglimetti's graph:
 - Plot the occurrence counts on a logarithmic scale, with different markers for each category of numbers.
 - Add a regression line to the plot to show the relationship between number size and occurrence count.
 - Save the plot as a PNG file.
+
+The counts can also be read from the binary output of gap.py (--format npy). The .npy files
+are memory-mapped and only the requested value range (--min/--max) is read.
+
+The categories are computed with tables up to the largest number: a prime sieve, all
+perfect powers b^e, and the highly composite numbers from a divisor-count sieve.
+
+With --render density the points are not drawn one by one. Each category is binned into a
+2-D grid (number x log count) and drawn as one image with log-scaled cell counts, so the
+rendering cost depends on the grid size and not on the number of points. The y axis then
+shows log10(count), labelled as powers of ten.
+
+With --profile PATH (or OEISTOOLS_PROFILE=PATH) the time of loading, classifying, drawing
+and saving is written to PATH at exit, see profiling.py.
 """
 
-def is_perfect_power(n):
-    """Check if n is a perfect power (square, cube, etc.)"""
-    if n < 2:
-        return False
-    # Check powers up to log2(n)
-    max_exp = int(np.log2(n)) + 1
-    for exp in range(2, max_exp + 1):
-        root = round(n ** (1/exp))
-        if root ** exp == n:
-            return True
-    return False
-
-def get_highly_composite_numbers(limit):
-    """Get all highly composite numbers up to limit"""
-    # Pre-computed set of highly composite numbers up to 100K
-    # Source: OEIS A002182
-    hcn = {1, 2, 4, 6, 12, 24, 36, 48, 60, 120, 180, 240, 360, 720, 840, 1260, 1680, 2520, 5040, 7560, 10080, 15120, 20160, 25200, 27720, 45360, 50400, 55440, 83160}
-    return {x for x in hcn if x <= limit}
-
-# Read the trimmed CSV file
-df = pd.read_csv('occurrence_counts_trimmed.csv')
-
-# Create arrays for different number types
-numbers = df['Number'].values
-counts = df['Count'].values
-
-# Calculate regression (using only positive numbers)
-mask = numbers > 0
-x = np.log(numbers[mask])
-y = np.log(counts[mask])
-slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
-
-# Create masks for different number types
-perfect_power_mask = [is_perfect_power(n) for n in numbers]
-hcn_set = get_highly_composite_numbers(max(numbers))
-highly_composite_mask = [n in hcn_set for n in numbers]
-prime_mask = [isprime(n) for n in numbers]
-regular_mask = ~(np.array(perfect_power_mask) | np.array(highly_composite_mask) | np.array(prime_mask))
-
-# Create the plot
-plt.figure(figsize=(10, 6))
-
-# Plot data
+DEFAULT_INPUT = 'occurrence_counts_trimmed.csv'
+DEFAULT_OUTPUT = 'occurrence_counts_plot.png'
+DEFAULT_BINS = (1000, 500)
+
+# Plot order, colour and marker size of the categories returned by classify()
 bigmarkersize = 3
 smallmarkersize = 1
-plt.semilogy(numbers[perfect_power_mask], counts[perfect_power_mask], 'g.', markersize=bigmarkersize, label='Perfect powers')
-plt.semilogy(numbers[highly_composite_mask], counts[highly_composite_mask], 'y.', markersize=bigmarkersize, label='Highly composite')
-plt.semilogy(numbers[prime_mask], counts[prime_mask], 'r.', markersize=bigmarkersize, label='Primes')
-plt.semilogy(numbers[regular_mask], counts[regular_mask], 'b.', markersize=smallmarkersize, label='Regular numbers')
-
-# Add regression line
-x_range = np.linspace(1, max(numbers), 1000)
-y_fit = np.exp(intercept + slope * np.log(x_range))
-plt.plot(x_range, y_fit, 'k-', label=f'Fit: log(count) = {slope:.2f}*log(n) + {intercept:.2f}')
-
-# Add labels and title
-plt.xlabel('Number')
-plt.ylabel('Count (log scale)')
-plt.title('OEIS Sequence Occurrence Counts')
-plt.grid(True)
-plt.legend()
-
-# Print regression statistics
-print(f"Regression results:")
-print(f"log(Count) = {slope:.3f} * log(n) + {intercept:.3f}")
-print(f"R-squared: {r_value**2:.3f}")
-
-# Save the plot
-plt.savefig('occurrence_counts_plot.png', dpi=300, bbox_inches='tight')
-plt.close() 
-print("Plot saved to occurrence_counts_plot.png")
\ No newline at end of file
+CATEGORIES = [
+    ('Perfect powers', 'g', bigmarkersize),
+    ('Highly composite', 'y', bigmarkersize),
+    ('Primes', 'r', bigmarkersize),
+    ('Regular numbers', 'b', smallmarkersize),
+]
+
+def prime_sieve(limit):
+    """Return a boolean array that is True at the primes in [0, limit]."""
+    is_prime = np.ones(limit + 1, dtype=bool)
+    is_prime[:2] = False
+    for p in range(2, isqrt(limit) + 1):
+        if is_prime[p]:
+            is_prime[p * p::p] = False
+    return is_prime
+
+def perfect_power_table(limit):
+    """Return a boolean array that is True at the perfect powers b^e (b, e >= 2) in [0, limit]."""
+    is_power = np.zeros(limit + 1, dtype=bool)
+    exp = 2
+    while 2 ** exp <= limit:
+        # Largest base with base^exp <= limit
+        root = int(round(limit ** (1 / exp)))
+        while root ** exp > limit:
+            root -= 1
+        while (root + 1) ** exp <= limit:
+            root += 1
+        is_power[np.arange(2, root + 1, dtype=np.int64) ** exp] = True
+        exp += 1
+    return is_power
+
+def divisor_counts(limit, is_prime):
+    """
+    Return an array with the number of divisors of every n in [0, limit] (0 for n = 0).
+
+    Only the primes up to sqrt(limit) are sieved with their exponents; what remains of n
+    after dividing them out is 1 or a single large prime.
+    """
+    counts = np.ones(limit + 1, dtype=np.int32)
+    rest = np.arange(limit + 1, dtype=np.int64)
+    for p in np.flatnonzero(is_prime[:isqrt(limit) + 1]):
+        p = int(p)
+        # Exponent of p in p*m for m = 1 .. limit // p
+        exponents = np.ones(limit // p, dtype=np.int32)
+        power = p
+        while power <= limit // p:
+            exponents[power - 1::power] += 1
+            power *= p
+        counts[p::p] *= exponents + 1
+        rest[p::p] //= np.power(p, exponents, dtype=np.int64)
+    counts[rest > 1] *= 2
+    counts[0] = 0
+    return counts
+
+def highly_composite_table(limit, is_prime):
+    """Return a boolean array that is True at the highly composite numbers (OEIS A002182) in [0, limit]."""
+    counts = divisor_counts(limit, is_prime)
+    is_hcn = np.zeros(limit + 1, dtype=bool)
+    # n is highly composite if it has more divisors than every smaller number
+    is_hcn[1:] = counts[1:] > np.maximum.accumulate(counts)[:-1]
+    return is_hcn
+
+def lookup(table, numbers):
+    """Look up numbers in a boolean table, numbers outside of the table are False."""
+    mask = np.zeros(len(numbers), dtype=bool)
+    valid = (numbers >= 0) & (numbers < len(table))
+    mask[valid] = table[numbers[valid]]
+    return mask
+
+def classify(numbers):
+    """Return boolean masks (perfect powers, highly composite, primes, regular) for numbers."""
+    numbers = np.asarray(numbers, dtype=np.int64)
+    limit = max(int(numbers.max()), 1) if len(numbers) else 1
+    is_prime = prime_sieve(limit)
+    perfect_power_mask = lookup(perfect_power_table(limit), numbers)
+    highly_composite_mask = lookup(highly_composite_table(limit, is_prime), numbers)
+    prime_mask = lookup(is_prime, numbers)
+    regular_mask = ~(perfect_power_mask | highly_composite_mask | prime_mask)
+    return perfect_power_mask, highly_composite_mask, prime_mask, regular_mask
+
+def load_counts(path, low=None, high=None):
+    """
+    Load sorted numbers and counts with low <= number < high.
+
+    A path ending in .csv is parsed as CSV. Any other path names the .npy pair written by
+    gap.py, either by its base name or by the .numbers.npy file. The .npy files are
+    memory-mapped, so only the requested range is read from disk.
+    """
+    if path.endswith('.csv'):
+        df = pd.read_csv(path)
+        numbers = df['Number'].values
+        counts = df['Count'].values
+        mask = np.ones(len(numbers), dtype=bool)
+        if low is not None:
+            mask &= numbers >= low
+        if high is not None:
+            mask &= numbers < high
+        return numbers[mask], counts[mask]
+
+    base = path[:-len('.numbers.npy')] if path.endswith('.numbers.npy') else path
+    numbers = np.load(f'{base}.numbers.npy', mmap_mode='r')
+    counts = np.load(f'{base}.counts.npy', mmap_mode='r')
+    start = 0 if low is None else np.searchsorted(numbers, low, side='left')
+    end = len(numbers) if high is None else np.searchsorted(numbers, high, side='left')
+    return np.array(numbers[start:end]), np.array(counts[start:end])
+
+def plot_points(numbers, counts, masks):
+    """Draw every number as a marker in the colour of its category."""
+    for (label, color, markersize), mask in zip(CATEGORIES, masks):
+        plt.semilogy(numbers[mask], counts[mask], f'{color}.', markersize=markersize, label=label)
+
+def plot_density(numbers, counts, masks, bins=DEFAULT_BINS):
+    """
+    Draw the categories as one density image over number x log10(count).
+
+    Each category is binned separately and coloured in its category colour with an
+    opacity that grows with the logarithm of the number of points in a cell. Empty cells
+    stay transparent. The categories are composited in plot order into a single RGBA
+    image. The y axis is linear in log10(count), so anything drawn on top of the image
+    has to use log10 counts as well.
+    """
+    x_range = (numbers.min(), numbers.max())
+    log_counts = np.log10(counts)
+    # Small margin so that counts of 1 and the largest count are not cut at the border
+    margin = 0.02 * max(log_counts.max(), 1)
+    y_range = (-margin, log_counts.max() + margin)
+    image = np.zeros((bins[1], bins[0], 4))
+    for (label, color, markersize), mask in zip(CATEGORIES, masks):
+        grid, _, _ = np.histogram2d(numbers[mask], log_counts[mask], bins=bins, range=(x_range, y_range))
+        density = np.log1p(grid.T)
+        alpha = np.where(density > 0, 0.3 + 0.7 * density / max(density.max(), 1e-12), 0.0)[..., None]
+        # Composite this category over the ones drawn before
+        image[..., :3] = np.array(to_rgb(color)) * alpha + image[..., :3] * (1 - alpha)
+        image[..., 3:] = alpha + image[..., 3:] * (1 - alpha)
+        # Empty plot for the legend entry
+        plt.plot([], [], f'{color}.', markersize=markersize, label=label)
+    # Above the grid lines (zorder 1.5), which would otherwise hide the row of counts that
+    # are a power of ten, e.g. the many counts of 1
+    plt.imshow(image, extent=(*x_range, *y_range), origin='lower', aspect='auto', interpolation='nearest', zorder=2)
+    axis = plt.gca().yaxis
+    axis.set_major_locator(MaxNLocator(integer=True))
+    axis.set_major_formatter(FuncFormatter(lambda y, pos: f'$10^{{{y:.0f}}}$'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Plot the occurrence counts computed by gap.py')
+    parser.add_argument('-i', '--input', type=str, help=f'Counts as CSV or .npy base name (default: {DEFAULT_INPUT})', default=DEFAULT_INPUT)
+    parser.add_argument('-o', '--output', type=str, help=f'Output image (default: {DEFAULT_OUTPUT})', default=DEFAULT_OUTPUT)
+    parser.add_argument('--min', type=int, help='Only plot numbers >= MIN', default=None)
+    parser.add_argument('--max', type=int, help='Only plot numbers < MAX', default=None)
+    parser.add_argument('--render', choices=['points', 'density'], help='Draw every point or a binned density grid (default: points)', default='points')
+    parser.add_argument('--bins', type=int, nargs=2, metavar=('X', 'Y'), help=f'Grid size of the density rendering (default: {DEFAULT_BINS[0]} {DEFAULT_BINS[1]})', default=DEFAULT_BINS)
+    parser.add_argument('--profile', type=str, metavar='PATH', help=f'Write per-phase timings to PATH at exit, .prom for a Prometheus textfile, else JSON (or set {profiling.PROFILE_ENV})', default=None)
+    args = parser.parse_args()
+    profile = profiling.setup(args.profile, "plot_counts.py")
+
+    # Read the trimmed counts
+    with profile.phase("load"):
+        numbers, counts = load_counts(args.input, args.min, args.max)
+    profile.add("numbers", len(numbers))
+
+    # Calculate regression (using only positive numbers)
+    with profile.phase("regression"):
+        mask = numbers > 0
+        x = np.log(numbers[mask])
+        y = np.log(counts[mask])
+        slope, intercept, r_value, p_value, std_err = stats.linregress(x, y)
+
+    # Create masks for different number types
+    with profile.phase("classify"):
+        masks = classify(numbers)
+
+    # Create the plot
+    plt.figure(figsize=(10, 6))
+
+    # Plot data
+    with profile.phase("plot"):
+        if args.render == 'density':
+            plot_density(numbers, counts, masks, tuple(args.bins))
+        else:
+            plot_points(numbers, counts, masks)
+
+    # Add regression line
+    x_range = np.linspace(1, max(numbers), 1000)
+    y_fit = np.exp(intercept + slope * np.log(x_range))
+    if args.render == 'density':
+        y_fit = np.log10(y_fit)  # The density plot has a log10 y axis
+    plt.plot(x_range, y_fit, 'k-', label=f'Fit: log(count) = {slope:.2f}*log(n) + {intercept:.2f}')
+
+    # Add labels and title
+    plt.xlabel('Number')
+    plt.ylabel('Count (log scale)')
+    plt.title('OEIS Sequence Occurrence Counts')
+    plt.grid(True)
+    plt.legend()
+
+    # Print regression statistics
+    print(f"Regression results:")
+    print(f"log(Count) = {slope:.3f} * log(n) + {intercept:.3f}")
+    print(f"R-squared: {r_value**2:.3f}")
+
+    # Save the plot
+    with profile.phase("save"):
+        plt.savefig(args.output, dpi=300, bbox_inches='tight')
+    plt.close()
+    print(f"Plot saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import heapq
+import atexit
+import resource
+from collections import Counter
+
+"""
+Optional instrumentation of the scripts: per-phase wall and CPU time, counters (files,
+bytes read, lines, tokens), the slowest files and the peak memory of a run.
+
+Profiling is off unless a script is started with --profile PATH or the environment
+variable OEISTOOLS_PROFILE=PATH is set. Then setup() installs a Profile as the module
+attribute profile, and its report is written to PATH when the script exits: as a
+Prometheus textfile if PATH ends in .prom, as JSON otherwise.
+
+While profiling is off, profile is a NullProfile whose hooks do nothing. Code paths that
+run per file check profile.enabled once and take their normal route when it is False.
+
+Phases are named by the code that times them and may nest, e.g. the "read" time of every
+file is part of "scan". Worker processes collect into a Profile of their own (see spawn()),
+which is merged into the main one like the aggregators of gap.py.
+"""
+
+PROFILE_ENV = "OEISTOOLS_PROFILE"
+DEFAULT_SLOWEST = 10
+
+class Phase:
+    """Context manager that adds its wall and CPU time to a phase of a Profile."""
+
+    __slots__ = ("profile", "name", "wall", "cpu")
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.add_time(self.name, time.perf_counter() - self.wall, time.process_time() - self.cpu)
+
+class Profile:
+    """Phase times, counters and the slowest files of one run (or of one chunk of a worker)."""
+
+    enabled = True
+
+    def __init__(self, script=None, slowest=DEFAULT_SLOWEST):
+        self.script = script
+        self.slowest = slowest
+        self.start = time.perf_counter()
+        self.phases = {}  # name -> [wall, cpu, calls]
+        self.counters = Counter()
+        self.files = []  # Min-heap of (seconds, name, bytes) of the slowest files
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_time(self, name, wall, cpu=0.0):
+        totals = self.phases.get(name)
+        if totals is None:
+            totals = self.phases[name] = [0.0, 0.0, 0]
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += 1
+
+    def add(self, name, value=1):
+        self.counters[name] += value
+
+    def add_file(self, name, seconds, size):
+        """Record the processing time of one file, keeping only the slowest ones."""
+        if len(self.files) < self.slowest:
+            heapq.heappush(self.files, (seconds, name, size))
+        elif seconds > self.files[0][0]:
+            heapq.heapreplace(self.files, (seconds, name, size))
+
+    def spawn(self):
+        """Return an empty profile with the same settings, e.g. for a worker process."""
+        return Profile(self.script, self.slowest)
+
+    def merge(self, other):
+        for name, (wall, cpu, calls) in other.phases.items():
+            totals = self.phases.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += calls
+        self.counters.update(other.counters)
+        for seconds, name, size in other.files:
+            self.add_file(name, seconds, size)
+
+    def report(self):
+        """Return the profile as a dict."""
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        return {
+            "script": self.script,
+            "wall_s": time.perf_counter() - self.start,
+            "cpu_s": sum(os.times()[:4]),
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            "peak_rss_children_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+            "phases": {name: {"wall_s": wall, "cpu_s": cpu, "calls": calls}
+                       for name, (wall, cpu, calls) in self.phases.items()},
+            "counters": dict(self.counters),
+            "slowest_files": [{"file": name, "seconds": seconds, "bytes": size}
+                              for seconds, name, size in sorted(self.files, reverse=True)],
+        }
+
+    def write(self, path):
+        """Write the report to path, as a Prometheus textfile for .prom and as JSON otherwise."""
+        report = self.report()
+        text = prometheus_text(report) if path.endswith(".prom") else json.dumps(report, indent=2) + "\n"
+        # Written atomically, so a textfile collector never reads half a file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+class NullProfile:
+    """Stand-in for Profile while profiling is off, every hook is a no-op."""
+
+    enabled = False
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def add_time(self, name, wall, cpu=0.0):
+        pass
+
+    def add(self, name, value=1):
+        pass
+
+    def add_file(self, name, seconds, size):
+        pass
+
+    def spawn(self):
+        return self
+
+    def merge(self, other):
+        pass
+
+class NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_PHASE = NullPhase()
+
+# The profile of the current process
+profile = NullProfile()
+
+def activate(new_profile):
+    """Make new_profile the profile of the current process, e.g. in a worker."""
+    global profile
+    profile = new_profile
+
+def setup(path, script, slowest=DEFAULT_SLOWEST):
+    """
+    Switch profiling on if path or the OEISTOOLS_PROFILE environment variable is set.
+
+    The report is written to that path at exit. Returns the profile of the process.
+    """
+    path = path or os.environ.get(PROFILE_ENV)
+    if path:
+        activate(Profile(script, slowest))
+        atexit.register(profile.write, path)
+    return profile
+
+def label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def prometheus_text(report):
+    """Format a report in the Prometheus text exposition format."""
+    script = f'script="{label(report["script"])}"'
+    lines = []
+
+    def metric(name, help_text, samples, kind="gauge"):
+        lines.append(f"# HELP oeistools_{name} {help_text}")
+        lines.append(f"# TYPE oeistools_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"oeistools_{name}{{{script}{labels}}} {value}")
+
+    metric("wall_seconds", "Wall time of the run.", [("", report["wall_s"])])
+    metric("cpu_seconds", "CPU time of the run, including waited-for child processes.", [("", report["cpu_s"])])
+    metric("peak_rss_bytes", "Peak resident set size of the process.", [("", report["peak_rss_bytes"])])
+    metric("peak_rss_children_bytes", "Largest peak resident set size of a child process.", [("", report["peak_rss_children_bytes"])])
+    phases = report["phases"].items()
+    metric("phase_wall_seconds", "Wall time per phase.", [(f',phase="{label(name)}"', p["wall_s"]) for name, p in phases])
+    metric("phase_cpu_seconds", "CPU time per phase.", [(f',phase="{label(name)}"', p["cpu_s"]) for name, p in phases])
+    metric("phase_calls_total", "Number of times a phase was entered.", [(f',phase="{label(name)}"', p["calls"]) for name, p in phases], "counter")
+    for name, value in report["counters"].items():
+        metric(f"{name}_total", f"Number of {name.replace('_', ' ')}.", [("", value)], "counter")
+    metric("slow_file_seconds", "Processing time of the slowest files.",
+           [(f',file="{label(f["file"])}"', f["seconds"]) for f in report["slowest_files"]])
+    return "\n".join(lines) + "\n"
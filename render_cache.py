@@ -0,0 +1,157 @@
+import os
+import json
+import shutil
+import hashlib
+import contextlib
+
+"""
+Content-addressed cache of the artifacts of sonification.py renders.
+
+A render has three stages, and the output of every stage is stored as a separate artifact
+under a key that hashes all inputs it depends on:
+
+- midi: the sequence, the gap cap, the instruments and the version of the rendering code
+- pcm: the key of the MIDI file, the content of the soundfont and the audio format (the
+  trimmed raw PCM that fluidsynth produced)
+- mp3: the key of the PCM and the bitrate
+
+So a render with a new bitrate only re-encodes the cached PCM, and a new soundfont skips
+the MIDI generation. Artifacts are stored as ROOT/<kind>/<first two hex digits>/<key>.<kind>.
+They are written atomically, so several processes of a batch render can share a cache.
+
+The cache is kept below a size limit by evicting the least recently used artifacts. Every
+hit touches the mtime of its file. A RenderCache counts the total size on its first write
+and then keeps it up to date with the size of every new artifact. Only when it goes over
+the limit is the tree walked again, and the oldest files are deleted until the total size
+is below the limit. Worker processes use process_cache(), so there is one RenderCache per
+process and the tree is walked once per worker and not once per job. The workers only
+count their own writes, so a shared cache can grow beyond the limit for a while;
+render_batch evicts once more at the end.
+"""
+
+DEFAULT_CACHE_DIR = ".render_cache"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Content hashes of files, by (path, size, mtime), so a soundfont of 100+ MB is hashed
+# once per process and not once per render
+_file_digests = {}
+
+# The RenderCache of every (root, max_bytes) in this process, see process_cache()
+_process_caches = {}
+
+def digest(*parts):
+    """Return the SHA-256 hex digest of JSON-serializable parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of the content of a file."""
+    st = os.stat(path)
+    stat_key = (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+    if stat_key not in _file_digests:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                sha.update(chunk)
+        _file_digests[stat_key] = sha.hexdigest()
+    return _file_digests[stat_key]
+
+def process_cache(root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+    """Return the RenderCache of root in this process, created on the first call."""
+    key = (root, max_bytes)
+    if key not in _process_caches:
+        _process_caches[key] = RenderCache(root, max_bytes)
+    return _process_caches[key]
+
+class RenderCache:
+    """The artifacts of renders in a folder, with LRU eviction above max_bytes."""
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = None  # Total size of the artifacts, counted on the first write
+
+    def path(self, kind, key):
+        return os.path.join(self.root, kind, key[:2], f"{key}.{kind}")
+
+    def open(self, kind, key):
+        """Return the artifact opened for reading and mark it as used, or None if it is not cached."""
+        path = self.path(kind, key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        # An open file stays readable even if another process evicts it now
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return f
+
+    def read(self, kind, key):
+        """Return the content of the artifact, or None if it is not cached."""
+        f = self.open(kind, key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    @contextlib.contextmanager
+    def writer(self, kind, key):
+        """
+        Context manager that returns a file to write an artifact to.
+
+        The artifact is only stored if the block finishes without an exception.
+        """
+        path = self.path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                yield f
+                size = f.tell()
+            os.replace(tmp_path, path)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+        self.added(size)
+
+    def write(self, kind, key, data):
+        with self.writer(kind, key) as f:
+            f.write(data)
+
+    def store_file(self, kind, key, file_path):
+        """Store a copy of file_path as an artifact."""
+        with self.writer(kind, key) as f, open(file_path, "rb") as src:
+            shutil.copyfileobj(src, f)
+
+    def added(self, size):
+        """Count a new artifact of size bytes, and evict if the cache is over its limit."""
+        if self.size is None:
+            self.size = sum(entry[1] for entry in self.entries())  # Includes the new artifact
+        else:
+            self.size += size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """Return (mtime, size, path) of all stored artifacts."""
+        entries = []
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(folder, name)
+                with contextlib.suppress(FileNotFoundError):
+                    st = os.stat(path)
+                    entries.append((st.st_mtime_ns, st.st_size, path))
+        return entries
+
+    def evict(self):
+        """Delete the least recently used artifacts until the cache is below max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+        self.size = total
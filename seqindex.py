@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import numpy as np
+
+"""
+This script answers the question "which sequences contain n?" from the inverted index
+that gap.py writes with --index DIR.
+
+The index files are memory-mapped, so a lookup only reads the keys it binary-searches
+and the postings of the numbers asked for.
+
+Examples:
+    python seqindex.py 42            # sequences containing 42
+    python seqindex.py 100 110       # sequences containing any number in [100, 110]
+"""
+
+DEFAULT_INDEX = "oeis_index"
+
+def open_index(index_dir=DEFAULT_INDEX):
+    """Memory-map the index files, returns (keys, offsets, postings)."""
+    return tuple(np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+                 for name in ("keys", "offsets", "postings"))
+
+def decode_varints(data):
+    """Decode a byte array of LEB128 varints, returns the values and the start offset of each."""
+    data = np.asarray(data, dtype=np.uint64)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    last = (data & np.uint64(0x80)) == 0
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    varint = np.cumsum(np.concatenate([[0], last[:-1]]))
+    shifts = (7 * (np.arange(len(data)) - starts[varint])).astype(np.uint64)
+    values = np.zeros(len(starts), dtype=np.uint64)
+    np.add.at(values, varint, (data & np.uint64(0x7F)) << shifts)
+    return values.astype(np.int64), starts
+
+def lookup_range(index, low, high):
+    """Return a dict from every indexed number in [low, high] to the sorted ids of the sequences containing it."""
+    keys, offsets, postings = index
+    first = int(np.searchsorted(keys, low, side="left"))
+    last = int(np.searchsorted(keys, high, side="right"))
+    if first == last:
+        return {}
+    start, end = int(offsets[first]), int(offsets[last])
+    deltas, starts = decode_varints(postings[start:end])
+    # Every key starts a new run of deltas; undo the delta encoding per run
+    first_varint = np.searchsorted(starts, np.asarray(offsets[first:last + 1]) - start)
+    totals = np.concatenate([[0], np.cumsum(deltas)])
+    return {int(keys[first + k]): totals[a + 1:b + 1] - totals[a]
+            for k, (a, b) in enumerate(zip(first_varint[:-1], first_varint[1:]))}
+
+def lookup(index, number):
+    """Return the sorted ids of the sequences containing number."""
+    return lookup_range(index, number, number).get(number, np.zeros(0, dtype=np.int64))
+
+def a_number(seq_id):
+    """Format a sequence id as an A-number."""
+    return f"A{seq_id:06d}"
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the OEIS sequences that contain a number or a range of numbers')
+    parser.add_argument('low', type=int, help='Number to look up, or start of the range')
+    parser.add_argument('high', type=int, nargs='?', help='End of the range (inclusive)', default=None)
+    parser.add_argument('-i', '--index', type=str, help=f'Index directory written by gap.py --index (default: {DEFAULT_INDEX})', default=DEFAULT_INDEX)
+    args = parser.parse_args()
+
+    index = open_index(args.index)
+    if args.high is None:
+        seq_ids = lookup(index, args.low)
+        print(f"{args.low} occurs in {len(seq_ids)} sequences: {' '.join(map(a_number, seq_ids))}")
+    else:
+        for number, seq_ids in lookup_range(index, args.low, args.high).items():
+            print(f"{number}: {len(seq_ids)} sequences: {' '.join(map(a_number, seq_ids))}")
+
+if __name__ == "__main__":
+    main()
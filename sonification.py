@@ -1,12 +1,44 @@
 #!/usr/bin/env python3
-from mido import Message, MidiFile, MidiTrack, MetaMessage
 import numpy as np
 import subprocess
 from pydub import AudioSegment
 import os
+import re
+import struct
+import logging
+import argparse
+import shutil
 import tempfile
+import contextlib
+from multiprocessing import Manager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from tqdm import tqdm
 from pydub.silence import detect_nonsilent
 
+from corpus import read_terms, seq_path
+from render_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, RenderCache, digest, file_digest, process_cache
+
+logger = logging.getLogger(__name__)
+
+"""
+Turns an integer sequence into music: the gaps between consecutive terms become the notes
+of a synth melody with bass and pad tracks, which fluidsynth renders to audio (MP3).
+
+Without arguments the SEQUENCE below is rendered. With A-numbers or ranges the sequences
+are read from the %S/%T/%U lines of a seq folder and rendered in a process pool, e.g.
+    python sonification.py A000045 A000108 A000001-A000100 --seq ./seq --workers 8
+Sequences that already have an MP3 in the output folder are skipped, unless --force is given.
+
+Unless the intermediate files are kept, a render does not touch the disk: the MIDI file is
+held in memory (a memfd on Linux), fluidsynth writes raw PCM into a pipe, and the PCM is
+trimmed and piped into the MP3 encoder chunk by chunk, so the memory use does not grow
+with the length of the track.
+
+With --cache the MIDI file, the trimmed PCM and the MP3 of every streamed render are kept
+in a content-addressed cache (see render_cache.py), so rendering a sequence again with the
+same inputs only copies the MP3, and e.g. a new --bitrate only re-encodes the PCM.
+"""
+
 # Define the sequence and its name as constants
 SEQUENCE = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109, 113, 127, 131, 137, 139, 149, 151, 157, 163, 167, 173, 179, 181, 191, 193, 197, 199, 211, 223, 227, 229, 233]
 NAME = "primes"  # Name of the sequence (used for default filenames)
@@ -39,9 +71,48 @@ NAME = "primes"  # Name of the sequence (used for default filenames)
 # SEQUENCE=[-20, 56, 55, 56, 55, 56, 51, 54, 52, 49, 32, 37, 40, 44, 49, 51, 32, 36, 44, 48, 51, 52, 32, 37, 44, 56, 55, 56, 55, 56, 51, 54, 52, 49, 32, 37, 40, 44, 49, 51, 32, 36, 44, 52, 51, 49, 32, 37, -20, 56, 55, 56, 55, 56, 51, 54, 52, 49, 32, 37, 40, 44, 49, 51, 32, 36, 44, 48, 51, 52, 32, 37]
 # NAME="fuerElise" #https://oeis.org/A123456
 
+OUTPUT_DIR = 'music_outputs'
+DATA_PATH = './seq'
+
+# Version of the rendering code, part of the cache keys: bump it when a change of the
+# MIDI generation or of the audio processing changes the output
+RENDER_VERSION = 1
+
+# General MIDI programs of the tracks
+INSTRUMENTS = {"melody": 80, "bass": 38, "pad": 90}  # Lead 1 square, synth bass, pad
+
+# Gaps are capped at this value before they are mapped to notes
+MAX_REASONABLE_GAP = 10000
+
+# Stages of a render, in order, as reported to the progress callback of sequence_to_mp3
+STAGES = ["read", "midi", "synth", "encode"]
+
+# Raw PCM format of the streaming render: 16 bit little-endian stereo
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+# Bytes read from the fluidsynth pipe at once
+PCM_CHUNK_SIZE = 64 * 1024
+
+# NumPy types of the samples that trim_silence scans itself, by sample width. Like
+# audioop, 8 bit samples are signed. Other widths use pydub's silence detection.
+SAMPLE_TYPES = {1: np.int8, 2: np.dtype("<i2")}
+# Number of windows (ms) that trim_silence checks at once
+TRIM_BLOCK = 1000
+
+def int_array(values):
+    """Return integers as an int64 array, or as an object array of Python ints if they do not fit."""
+    try:
+        return np.asarray(values, dtype=np.int64)
+    except OverflowError:
+        return np.array([int(value) for value in values], dtype=object)
+
 def compute_gaps(sequence):
-    """Compute gaps between consecutive terms in the sequence."""
-    return [sequence[i] - sequence[i-1] for i in range(1,len(sequence))]
+    """Compute gaps between consecutive terms in the sequence, as an array."""
+    terms = int_array(sequence)
+    if terms.dtype != object and len(terms) and (terms.min() < -2**62 or terms.max() >= 2**62):
+        terms = terms.astype(object)  # The differences could overflow int64
+    return np.diff(terms)
 
 def normalize_gaps(gaps, min_note=36, max_note=84):
     """
@@ -53,131 +124,166 @@ def normalize_gaps(gaps, min_note=36, max_note=84):
     in between.
 
     Args:
-        gaps: List of integer gaps between consecutive sequence numbers
+        gaps: Integer gaps between consecutive sequence numbers (may be bignums)
         min_note: Lowest MIDI note number to use (default 36/C2)
         max_note: Highest MIDI note number to use (default 84/C6)
 
     Returns:
-        List of MIDI note numbers scaled between min_note and max_note.
-        Returns empty list if gaps is empty.
-        Returns list of middle C (60) if all gaps are equal.
+        Array of MIDI note numbers scaled between min_note and max_note.
+        Returns an empty array if gaps is empty.
+        Returns middle C (60) for every gap if all gaps are equal.
     """
-    if not gaps:
-        return []
+    gaps = int_array(gaps)
+    if not len(gaps):
+        return np.zeros(0, dtype=np.int64)
     
-    min_gap = min(gaps)
-    max_gap = max(gaps)
+    min_gap = gaps.min()
+    max_gap = gaps.max()
     
     # Handle the case where all gaps are the same
     if min_gap == max_gap:
-        return [60] * len(gaps)  # Middle C for all notes - avoids division by zero
+        return np.full(len(gaps), 60, dtype=np.int64)  # Middle C for all notes - avoids division by zero
     
     # Linear mapping from gap range to note range
     # Formula: new_value = min_new + (value - min_old)/(max_old - min_old) * (max_new - min_new)
-    normalized = []
-    for gap in gaps:
-        # Map gap to note range using linear interpolation
-        print(f"gap: {gap}, min_gap: {min_gap}, max_gap: {max_gap}")
-        note = min_note + ((gap - min_gap) / (max_gap - min_gap)) * (max_note - min_note)
-        print(f"note: {note}")
-        normalized.append(int(round(note)))  # Round to nearest MIDI note number
-    
-    return normalized
+    gap_range = int(max_gap) - int(min_gap)
+    if gaps.dtype != object and gap_range < 2**53:
+        # The differences are exact as floats, so this rounds exactly like the division of Python ints
+        notes = min_note + ((gaps - min_gap) / gap_range) * (max_note - min_note)
+    else:
+        notes = np.array([min_note + ((gap - min_gap) / gap_range) * (max_note - min_note) for gap in gaps])
+    logger.debug("Mapped %d gaps in [%s, %s] to MIDI notes", len(gaps), min_gap, max_gap)
+    # Round to nearest MIDI note number, half to even like round()
+    return np.rint(notes).astype(np.int64)
 
-def create_synth_midi(gaps, filename=None):
-    """Create a MIDI file with synthesizer sounds based on sequence gaps."""
-    midi = MidiFile(ticks_per_beat=480)
-    
-    ## MELODY Track
-    # Create a track for the melody (based on gaps)
-    melody_track = MidiTrack()
-    midi.tracks.append(melody_track)
-    
-    # Set tempo and instrument
-    melody_track.append(MetaMessage('set_tempo', tempo=400000, time=0))  # 150 BPM
-    melody_track.append(Message('program_change', program=80, time=0))  # Synth lead (program 80 = Lead 1 square)
+def encode_varint(value):
+    """Encode a delta time as a MIDI variable-length quantity."""
+    groups = [value & 0x7F]
+    value >>= 7
+    while value:
+        groups.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(groups))
+
+def encode_events(events, running_status=None):
+    """
+    Encode (delta time, status byte, data bytes) events of a track like mido does.
+
+    The status byte is left out if it equals the one of the previous event (running status).
+    Returns the bytes and the running status after the last event.
+    """
+    data = bytearray()
+    for delta, status, values in events:
+        data += encode_varint(delta)
+        if status != running_status:
+            data.append(status)
+        data += bytes(values)
+        running_status = status
+    return data, running_status
+
+def event_rows(*columns):
+    """
+    Return one row of bytes per note, from constant byte strings and per-note arrays.
+
+    Every bytes argument adds its bytes to all rows, every array one byte per row.
+    """
+    count = next(len(column) for column in columns if not isinstance(column, bytes))
+    parts = [np.tile(np.frombuffer(column, dtype=np.uint8), (count, 1)) if isinstance(column, bytes)
+             else np.asarray(column, dtype=np.uint8)[:, None] for column in columns]
+    return np.hstack(parts)
+
+def midi_chunk(kind, data):
+    return kind + struct.pack(">L", len(data)) + bytes(data)
+
+def create_synth_midi(gaps, filename=None, instruments=INSTRUMENTS):
+    """
+    Create a MIDI file with synthesizer sounds based on sequence gaps.
+
+    instruments are the programs of the melody, bass and pad tracks. The events of the
+    tracks are encoded to bytes directly, with NumPy for the per-note events, which gives
+    the same file as building it from mido messages. Returns the MIDI file as bytes.
+    """
+    ticks_per_beat = 480
+    NOTE_ON, NOTE_OFF, PROGRAM_CHANGE = 0x90, 0x80, 0xC0  # Channel 0
     
     # Normalize gaps to MIDI note range
     notes = normalize_gaps(gaps)
+    if len(notes) and (notes.min() < 0 or notes.max() > 127):
+        raise ValueError("MIDI notes must be in 0..127")
     
     # Fixed note duration and spacing for consistent timing
     note_duration = 120  # Duration of each note
     note_spacing = 240   # Time between consecutive notes
     
-    # Add notes based on gaps
-    for i, note in enumerate(notes):
-        # Vary velocity based on note value
-        velocity = min(127, 70 + (note % 20))  # Higher notes slightly louder
-        
-        # Note on - starts playing the note with specified pitch, velocity (loudness), and timing
-        # time=note_spacing ensures consistent rhythmic spacing between consecutive notes
-        # This creates the actual sound event in the MIDI sequence
-        melody_track.append(Message('note_on', note=note, velocity=velocity, time=note_spacing))
-        
-        # Add a harmony note to create a richer sound
-        # For each melody note, we add either a perfect fifth (7 semitones) or perfect fourth (5 semitones)
-        # The choice between fifth/fourth depends on the note value to add variety
-        # Notes below middle C (value % 12 < 6) get a fifth, others get a fourth
-        harmony_interval = 7 if note % 12 < 6 else 5  # Perfect fifth or perfect fourth
-        harmony_note = note + harmony_interval
-        
-        # Only add harmony if it's within MIDI note range (0-127)
-        if harmony_note < 127:
-            # Add harmony note at slightly lower velocity (-20) for balance
-            melody_track.append(Message('note_on', note=harmony_note, velocity=velocity-20, time=0))
-            # Turn off harmony note after note_duration
-            melody_track.append(Message('note_off', note=harmony_note, velocity=0, time=note_duration))
-        
-        # Turn off the main melody note
-        melody_track.append(Message('note_off', note=note, velocity=0, time=0))
+    ## MELODY Track
+    # Set tempo (150 BPM) and instrument
+    melody_track = bytearray(b"\x00\xff\x51\x03" + (400000).to_bytes(3, "big"))
+    melody_track += b"\x00" + bytes([PROGRAM_CHANGE, instruments["melody"]])
+    
+    # Vary velocity based on note value, higher notes slightly louder
+    velocity = np.minimum(127, 70 + notes % 20)
+    # For each melody note, we add either a perfect fifth (7 semitones) or perfect fourth (5 semitones)
+    # Notes below middle C (value % 12 < 6) get a fifth, others get a fourth
+    harmony = notes + np.where(notes % 12 < 6, 7, 5)
+    # Only add harmony if it's within MIDI note range (0-127)
+    has_harmony = harmony < 127
+    harmony = np.where(has_harmony, harmony, 0)
+    
+    # Per note: melody note on after note_spacing, harmony note on (at lower velocity) and
+    # off after note_duration, melody note off. Consecutive events of the same type share
+    # their status byte (running status).
+    rows = event_rows(encode_varint(note_spacing), bytes([NOTE_ON]), notes, velocity,
+                      b"\x00", harmony, velocity - 20, encode_varint(note_duration), bytes([NOTE_OFF]), harmony, b"\x00",
+                      b"\x00", notes, b"\x00")
+    harmony_columns = np.zeros(rows.shape[1], dtype=bool)
+    # Without harmony the note off follows the note on directly: drop from the harmony
+    # note to the delta before the melody note off, but keep the note off status byte
+    first = len(encode_varint(note_spacing)) + 4
+    status_off = first + 2 + len(encode_varint(note_duration))
+    harmony_columns[first:status_off] = True
+    harmony_columns[status_off + 1:status_off + 4] = True
+    keep = np.ones(rows.shape, dtype=bool)
+    keep[~has_harmony] = ~harmony_columns
+    melody_track += rows[keep].tobytes()
+    running_status = NOTE_OFF if len(notes) else PROGRAM_CHANGE
+    melody_ticks = note_spacing * len(notes) + note_duration * int(has_harmony.sum())
 
     # Add a final chord for resolution to the melody track
-    final_note = notes[-1]
+    final_note = int(notes[-1])
     final_chord = [final_note-12, final_note-5, final_note, final_note+7]
 
     # Extended hold time for the final chord
     extended_hold_time = note_spacing * 3
     
-    # Add final chord with proper timing
-    melody_track.append(Message('note_on', note=final_chord[0], velocity=90, time=note_spacing))
-    for note in final_chord[1:]:
-        if 0 <= note < 127:
-            melody_track.append(Message('note_on', note=note, velocity=90, time=0))
-    
-    # Hold the final chord
-    for i, note in enumerate(final_chord):
-        if 0 <= note < 127:
-            melody_track.append(Message('note_off', note=note, velocity=0, 
-                                      time=extended_hold_time if i == 0 else 0))
+    # Add final chord with proper timing, then hold it
+    events = [(note_spacing, NOTE_ON, (final_chord[0], 90))]
+    events += [(0, NOTE_ON, (note, 90)) for note in final_chord[1:] if 0 <= note < 127]
+    events += [(extended_hold_time if i == 0 else 0, NOTE_OFF, (note, 0))
+               for i, note in enumerate(final_chord) if 0 <= note < 127]
+    melody_track += encode_events(events, running_status)[0]
+    melody_ticks += sum(event[0] for event in events)
     
     ## BASS Track
-    # Create a track for the bass/rhythm
-    bass_track = MidiTrack()
-    midi.tracks.append(bass_track)
-    bass_track.append(Message('program_change', program=38, time=0))  # Synth bass
+    bass_track = bytearray(b"\x00" + bytes([PROGRAM_CHANGE, instruments["bass"]]))
     
-    # Add bass notes with proper timing
+    # Add bass notes with proper timing, one bass note every 4 melody notes,
+    # one octave lower but not too low.
     # The bass track will be shorter because it does not account for the final chord.
-    bass_time = 0
-    for i in range(0, len(notes), 4):  # One bass note every 4 melody notes
-        if i < len(notes):
-            bass_note = max(24, notes[i] - 24)  # One octave lower, but not too low
-    
-            # First bass note starts immediately, others after 4 note spacings
-            bass_track.append(Message('note_on', note=bass_note, velocity=100, time= 0 if i==0 else note_spacing * 4))
-    
-            # Bass note duration
-            bass_track.append(Message('note_off', note=bass_note, velocity=0, time=note_spacing * 2))
-
+    bass_notes = np.maximum(24, notes[::4] - 24)
+    # First bass note starts immediately, others after 4 note spacings
+    events = [(0, NOTE_ON, (int(bass_notes[0]), 100)), (note_spacing * 2, NOTE_OFF, (int(bass_notes[0]), 0))]
+    bass_track += encode_events(events, PROGRAM_CHANGE)[0]
+    if len(bass_notes) > 1:
+        bass_track += event_rows(encode_varint(note_spacing * 4), bytes([NOTE_ON]), bass_notes[1:], b"\x64",
+                                 encode_varint(note_spacing * 2), bytes([NOTE_OFF]), bass_notes[1:], b"\x00").tobytes()
+    bass_ticks = note_spacing * 4 * (len(bass_notes) - 1) + note_spacing * 2 * len(bass_notes)
     
     ## PAD Track
     # Add a pad track for atmosphere
-    pad_track = MidiTrack()
-    midi.tracks.append(pad_track)
-    pad_track.append(Message('program_change', program=90, time=0))  # Pad sound
+    pad_track = bytearray(b"\x00" + bytes([PROGRAM_CHANGE, instruments["pad"]]))
     
     # Create chord progression based on the sequence
-    unique_notes = sorted(set(notes))
+    unique_notes = np.unique(notes).tolist()
     if len(unique_notes) >= 4:
         chord_notes = [unique_notes[0], unique_notes[len(unique_notes)//3], 
                       unique_notes[2*len(unique_notes)//3], unique_notes[-1]]
@@ -192,6 +298,7 @@ def create_synth_midi(gaps, filename=None):
     section_length = total_melody_duration // section_count
     
     # Add chord sections with proper timing
+    events = []
     for section in range(section_count):
         # Select chord for this section
         root_note = chord_notes[section % len(chord_notes)]
@@ -200,110 +307,534 @@ def create_synth_midi(gaps, filename=None):
         # Start time for this section
         section_start_time = section * section_length if section > 0 else 0
     
-        # Add chord notes
-        for i, note in enumerate(chord):
-            if 0 <= note < 127:
-                pad_track.append(Message('note_on', note=note, 
-                                       velocity=50, 
-                                       time=section_start_time if i == 0 else 0))
-    
-        # Hold chord for section duration
-        for i, note in enumerate(chord):
-            if 0 <= note < 127:
-                pad_track.append(Message('note_off', note=note, 
-                                        velocity=0, 
-                                        time=0))
-
+        # Add chord notes, then release them
+        events += [(section_start_time if i == 0 else 0, NOTE_ON, (note, 50))
+                   for i, note in enumerate(chord) if 0 <= note < 127]
+        events += [(0, NOTE_OFF, (note, 0)) for note in chord if 0 <= note < 127]
+    pad_track += encode_events(events, PROGRAM_CHANGE)[0]
+    pad_ticks = sum(event[0] for event in events)
 
     ## This outputs stats about the MIDI tracks        
-    debug_midi_tracks(midi)
+    debug_midi_tracks([melody_ticks, bass_ticks, pad_ticks], ticks_per_beat)
+
+    # Type 1 file with three tracks, each closed by an end_of_track meta event
+    midi = midi_chunk(b"MThd", struct.pack(">hhh", 1, 3, ticks_per_beat))
+    for track in (melody_track, bass_track, pad_track):
+        midi += midi_chunk(b"MTrk", track + b"\x00\xff\x2f\x00")
     
     if filename:
-        midi.save(filename)
+        with open(filename, "wb") as f:
+            f.write(midi)
         print(f"MIDI file saved as {filename}")
     return midi
 
-def debug_midi_tracks(midi):
-    """Prints the events of each track in the MIDI file for debugging purposes and calculates track durations."""
-    ticks_per_beat = midi.ticks_per_beat
+def debug_midi_tracks(track_ticks, ticks_per_beat=480):
+    """Prints the duration of each track of the MIDI file, given the total ticks of each track."""
     tempo = 400000  # microseconds per beat (150 BPM)
     seconds_per_tick = tempo / 1_000_000 / ticks_per_beat
     
-    for i, track in enumerate(midi.tracks):
-        print(f"Track {i}: {track.name if track.name else 'Unnamed'}")
-        total_ticks = 0
-        for msg in track:
-            total_ticks += msg.time
-            # if not msg.is_meta:
-            #     print(f"{msg.type}: note={msg.note}, velocity={msg.velocity}, time={msg.time}")
-            # else:
-            #     print(f"Meta: {msg.type}, time={msg.time}")
+    for i, total_ticks in enumerate(track_ticks):
+        print(f"Track {i}: Unnamed")
         track_duration_seconds = total_ticks * seconds_per_tick
         print(f"Total duration for Track {i}: {track_duration_seconds:.2f} seconds")
 
-def trim_silence(audio_segment, silence_thresh=-50.0, chunk_size=10):
-    """Trim silence from the end of an audio segment."""
-    non_silent_ranges = detect_nonsilent(audio_segment, min_silence_len=chunk_size, silence_thresh=silence_thresh)
-    if non_silent_ranges:
-        # Get the end of the last non-silent range
-        end_trim = non_silent_ranges[-1][1]
-        return audio_segment[:end_trim]
-    return audio_segment
-
-def sequence_to_mp3(sequence, name=NAME, mp3_filename=None, keep_intermediates=False, sf2_file="FluidR3_GM.sf2"):
-    """Convert a sequence directly to MP3, optionally keeping intermediate files."""
+def frame_index(ms, frame_rate):
+    """First frame of a position in ms, rounded down like pydub slicing."""
+    return (np.asarray(ms) * (frame_rate / 1000.0)).astype(np.int64)
+
+def silence_threshold(silence_thresh, sample_width):
+    """RMS of silence_thresh dBFS, relative to half the range of the sample width as in pydub."""
+    return 10 ** (silence_thresh / 20) * (2 ** (8 * sample_width) / 2)
+
+def frame_energy(samples, channels):
+    """Sum of the squared samples of every frame."""
+    samples = np.asarray(samples, dtype=np.int64)
+    return (samples ** 2).reshape(-1, channels).sum(axis=1)
+
+def silent_windows(sums, base, frame_count, starts, chunk_size, frame_rate, channels, threshold):
+    """
+    Return which windows of chunk_size ms, starting at starts (ms), are silent.
+
+    sums are the cumulative sums of frame_energy from frame base on, with a leading 0.
+    Frames from frame_count on count as zeros, like the padding of pydub slices. A window
+    is silent if its RMS, truncated like audioop.rms, is at most threshold.
+    """
+    first, last = frame_index(starts, frame_rate), frame_index(starts + chunk_size, frame_rate)
+    squares = sums[np.minimum(last, frame_count) - base] - sums[first - base]
+    rms = np.floor(np.sqrt(squares / ((last - first) * channels)))
+    return rms <= threshold
+
+def silent_run(samples, channels, frame_rate, length, chunk_size, threshold, reverse):
+    """
+    Find the range of silent windows at the start (or with reverse, at the end) of the samples.
+
+    Returns the start (ms) of its window farthest from that end, or None if the first (last)
+    window is not silent. Silent windows up to chunk_size ms apart belong to one range, as
+    in pydub's detect_silence. The windows are checked in blocks of TRIM_BLOCK, and the
+    scan stops as soon as the range is over.
+    """
+    frame_count = len(samples) // channels
+    last_window = length - chunk_size
+    position = last_window if reverse else 0  # Next window to check
+    edge = None
+    while 0 <= position <= last_window:
+        if reverse:
+            starts = np.arange(max(position - TRIM_BLOCK + 1, 0), position + 1)
+        else:
+            starts = np.arange(position, min(position + TRIM_BLOCK, last_window + 1))
+        first = int(frame_index(starts[0], frame_rate))
+        end = min(int(frame_index(starts[-1] + chunk_size, frame_rate)), frame_count)
+        sums = np.concatenate([[0], np.cumsum(frame_energy(samples[first * channels:end * channels], channels))])
+        silent = silent_windows(sums, first, frame_count, starts, chunk_size, frame_rate, channels, threshold)
+        silent_starts = starts[silent][::-1] if reverse else starts[silent]
+        if edge is None:
+            if not len(silent_starts) or silent_starts[0] != position:
+                return None
+            edge = position
+        # The range ends before the first silent window that is too far from the previous one
+        steps = np.abs(np.diff(np.concatenate([[edge], silent_starts])))
+        breaks = np.flatnonzero(steps > chunk_size)
+        if len(breaks):
+            return int(silent_starts[breaks[0] - 1]) if breaks[0] else edge
+        if len(silent_starts):
+            edge = int(silent_starts[-1])
+        position = starts[0] - 1 if reverse else starts[-1] + 1
+        if abs(position - edge) > chunk_size:
+            return edge
+    return edge
+
+def trim_silence(audio_segment, silence_thresh=-50.0, chunk_size=10, leading=False):
+    """
+    Trim silence from the end of an audio segment, and with leading also from its start.
+
+    The result is the same as cutting at the last (and first) non-silent range of pydub's
+    detect_nonsilent with min_silence_len=chunk_size. The raw samples are scanned from the
+    end in blocks of vectorized RMS windows, and the scan stops at the first sound, so the
+    cost grows with the length of the silence and not of the track.
+    """
+    dtype = SAMPLE_TYPES.get(audio_segment.sample_width)
+    if dtype is None:
+        non_silent_ranges = detect_nonsilent(audio_segment, min_silence_len=chunk_size, silence_thresh=silence_thresh)
+        if non_silent_ranges:
+            # Get the start of the first and the end of the last non-silent range
+            start_trim = non_silent_ranges[0][0] if leading else 0
+            return audio_segment[start_trim:non_silent_ranges[-1][1]]
+        return audio_segment
+    length = len(audio_segment)
+    if length < chunk_size:
+        return audio_segment[:length]  # No window fits, so nothing is silent
+    samples = np.frombuffer(audio_segment.raw_data, dtype=dtype)
+    scan = (samples, audio_segment.channels, audio_segment.frame_rate, length, chunk_size,
+            silence_threshold(silence_thresh, audio_segment.sample_width))
+    end_run = silent_run(*scan, reverse=True)
+    if end_run == 0:
+        return audio_segment  # All silent
+    end_trim = length if end_run is None else end_run
+    start_trim = 0
+    if leading:
+        start_run = silent_run(*scan, reverse=False)
+        if start_run is not None:
+            start_trim = start_run + chunk_size
+    return audio_segment[start_trim:end_trim]
+
+class SilenceTrimmer:
+    """
+    Trims the silence at the end of a stream of raw PCM chunks, like trim_silence.
+
+    Silence is detected exactly as pydub's detect_nonsilent does: a window of chunk_size ms
+    starting at every ms is silent if its RMS is at most silence_thresh dBFS, and silent
+    windows less than chunk_size ms apart form one silent range. feed() returns the audio
+    that can no longer belong to the trailing silent range, finish() the rest. Only the
+    current run of silent windows is held back, not the track.
+    """
+
+    def __init__(self, silence_thresh=-50.0, chunk_size=10, frame_rate=SAMPLE_RATE, channels=CHANNELS, sample_width=SAMPLE_WIDTH):
+        self.chunk_size = chunk_size
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.dtype = np.dtype(f"<i{sample_width}")
+        self.frame_width = channels * sample_width
+        self.threshold = silence_threshold(silence_thresh, sample_width)
+        self.pending = bytearray()  # Audio not emitted yet, starting at frame self.base
+        self.energy = np.zeros(0, dtype=np.int64)  # Sum of squared samples of every complete pending frame
+        self.base = 0
+        self.next_window = 0  # Start (ms) of the first window not checked yet
+        self.chain_start = None  # Start of the last range of silent windows
+        self.last_silent = None  # Start of the last silent window
+
+    def frame(self, ms):
+        return frame_index(ms, self.frame_rate)
+
+    def check_windows(self, last_window, frame_count):
+        """Check the windows up to last_window (ms) against frames up to frame_count, zero-padded beyond."""
+        starts = np.arange(self.next_window, last_window + 1)
+        if not len(starts):
+            return
+        sums = np.concatenate([[0], np.cumsum(self.energy)])
+        silent = silent_windows(sums, self.base, frame_count, starts, self.chunk_size, self.frame_rate,
+                                self.channels, self.threshold)
+        silent_starts = starts[silent]
+        self.next_window = last_window + 1
+        if not len(silent_starts):
+            return
+        # A new range starts after a gap of more than chunk_size ms between silent windows
+        previous = np.concatenate([[self.last_silent if self.last_silent is not None else -2 * self.chunk_size], silent_starts[:-1]])
+        breaks = np.flatnonzero(silent_starts - previous > self.chunk_size)
+        if len(breaks):
+            self.chain_start = int(silent_starts[breaks[-1]])
+        self.last_silent = int(silent_starts[-1])
+
+    def emit(self, end_frame):
+        """Return the pending audio before end_frame and drop it."""
+        end = (end_frame - self.base) * self.frame_width
+        out = bytes(self.pending[:end])
+        del self.pending[:end]
+        self.energy = self.energy[end_frame - self.base:]
+        self.base = end_frame
+        return out
+
+    def feed(self, chunk):
+        complete = len(self.pending) // self.frame_width
+        self.pending += chunk
+        # The view of the buffer is dropped at once, so it can be resized later
+        energy = frame_energy(np.frombuffer(self.pending, dtype=self.dtype,
+                                            count=(len(self.pending) // self.frame_width - complete) * self.channels,
+                                            offset=complete * self.frame_width), self.channels)
+        self.energy = np.concatenate([self.energy, energy])
+        available = self.base + len(self.energy)
+        # Last window that ends within the frames read so far
+        last_window = int(available / (self.frame_rate / 1000.0)) - self.chunk_size + 1
+        while last_window >= 0 and self.frame(last_window + self.chunk_size) > available:
+            last_window -= 1
+        self.check_windows(last_window, available)
+        # Audio before the start of a silent range that may still reach the end is held back
+        if self.last_silent is not None and self.last_silent + self.chunk_size >= self.next_window:
+            return self.emit(int(self.frame(self.chain_start)))
+        return self.emit(int(self.frame(self.next_window)))
+
+    def finish(self):
+        frame_count = self.base + len(self.energy)
+        self.pending = self.pending[:(frame_count - self.base) * self.frame_width]
+        length = round(1000 * (frame_count / self.frame_rate))  # len() of a pydub AudioSegment
+        self.check_windows(length - self.chunk_size, frame_count)
+        end_ms = length
+        if self.last_silent is not None and self.last_silent == length - self.chunk_size:
+            if self.chain_start == 0:
+                return self.emit(frame_count)  # All silent, trim_silence keeps everything
+            end_ms = self.chain_start
+        end_frame = int(self.frame(end_ms))
+        # Slicing pydub audio beyond its end pads it with silence
+        padding = bytes(max(end_frame - frame_count, 0) * self.frame_width)
+        return self.emit(min(end_frame, frame_count)) + padding
+
+def trim_stream(chunks, silence_thresh=-50.0, chunk_size=10):
+    """Trim the trailing silence of a stream of raw PCM chunks, yielding the trimmed audio."""
+    trimmer = SilenceTrimmer(silence_thresh, chunk_size)
+    for chunk in chunks:
+        out = trimmer.feed(chunk)
+        if out:
+            yield out
+    yield trimmer.finish()
+
+@contextlib.contextmanager
+def memory_file(data, suffix=""):
+    """
+    Yield the path and file descriptor of a file with contents data for a subprocess.
+
+    On Linux the file is a memfd, opened through /dev/fd, and the descriptor has to be
+    passed to the subprocess. Elsewhere it is a temporary file and the descriptor is None.
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create(f"sonification{suffix}")
+        try:
+            with os.fdopen(os.dup(fd), "wb") as f:
+                f.write(data)
+            yield f"/dev/fd/{fd}", fd
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            f.write(data)
+            f.flush()
+            yield f.name, None
+
+def render_pcm(midi_data, sf2_file, quiet=False, chunk_size=PCM_CHUNK_SIZE):
+    """Render MIDI file contents with fluidsynth and yield the raw PCM in chunks, read from a pipe."""
+    with memory_file(midi_data, ".mid") as (midi_file, midi_fd):
+        read_fd, write_fd = os.pipe()
+        command = [
+            "fluidsynth",
+            "-ni", sf2_file, midi_file,
+            "-F", f"/dev/fd/{write_fd}", "-T", "raw", "-O", "s16", "-E", "little", "-r", str(SAMPLE_RATE)
+        ]
+        # The audio goes to its own pipe, so the messages of fluidsynth on stdout cannot mix with it
+        pass_fds = (write_fd,) if midi_fd is None else (write_fd, midi_fd)
+        # The read end is wrapped first, so it is closed even if fluidsynth cannot be started
+        with os.fdopen(read_fd, "rb") as pipe:
+            try:
+                process = subprocess.Popen(command, pass_fds=pass_fds, stdout=subprocess.DEVNULL if quiet else None,
+                                           stderr=subprocess.DEVNULL if quiet else None)
+            finally:
+                os.close(write_fd)
+            try:
+                while chunk := pipe.read(chunk_size):
+                    yield chunk
+                if process.wait():
+                    raise subprocess.CalledProcessError(process.returncode, command)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+
+def encode_mp3(chunks, mp3_filename, bitrate="192k"):
+    """Encode a stream of raw PCM chunks to MP3, piping them into ffmpeg as they arrive."""
+    command = [
+        AudioSegment.converter, "-y", "-loglevel", "error",
+        "-f", f"s{8 * SAMPLE_WIDTH}le", "-ar", str(SAMPLE_RATE), "-ac", str(CHANNELS), "-i", "pipe:0",
+        "-b:a", bitrate, "-f", "mp3", mp3_filename
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+    finally:
+        process.stdin.close()
+        process.wait()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+def mp3_path(name, output_dir=OUTPUT_DIR):
+    """Return the default MP3 file of a sequence name."""
+    return os.path.join(output_dir, f"{name.lower()}.mp3")
+
+def render_keys(sequence, max_reasonable_gap, instruments, sf2_file, bitrate):
+    """Return the cache keys of the midi, pcm and mp3 artifacts of a render, see render_cache.py."""
+    midi_key = digest("midi", RENDER_VERSION, [int(term) for term in sequence], max_reasonable_gap, instruments)
+    pcm_key = digest("pcm", midi_key, file_digest(sf2_file), SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH)
+    return {"midi": midi_key, "pcm": pcm_key, "mp3": digest("mp3", pcm_key, bitrate)}
+
+def trimmed_pcm(gaps, sf2_file, instruments, quiet, progress, cache=None, keys=None):
+    """
+    Yield the trimmed raw PCM of a render in chunks.
+
+    With a cache, the PCM (or else the MIDI file) is taken from it if it is there, and what
+    had to be rendered is stored in it.
+    """
+    cached_pcm = cache.open("pcm", keys["pcm"]) if cache else None
+    if cached_pcm is not None:
+        progress("midi")
+        progress("synth")
+        with cached_pcm:
+            while chunk := cached_pcm.read(PCM_CHUNK_SIZE):
+                yield chunk
+        return
+
+    midi = cache.read("midi", keys["midi"]) if cache else None
+    if midi is None:
+        midi = create_synth_midi(gaps, instruments=instruments)
+        if cache:
+            cache.write("midi", keys["midi"], midi)
+    progress("midi")
+
+    def synthesized():
+        yield from render_pcm(midi, sf2_file, quiet=quiet)
+        progress("synth")
+
+    chunks = trim_stream(synthesized())
+    if not cache:
+        yield from chunks
+        return
+    # The PCM is only stored if the render gets to the end
+    with cache.writer("pcm", keys["pcm"]) as f:
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+
+def sequence_to_mp3(sequence, name=NAME, mp3_filename=None, keep_intermediates=False, sf2_file="FluidR3_GM.sf2",
+                    output_dir=OUTPUT_DIR, progress=None, quiet=False, max_reasonable_gap=MAX_REASONABLE_GAP,
+                    instruments=INSTRUMENTS, bitrate="192k", cache=None):
+    """
+    Convert a sequence directly to MP3, optionally keeping intermediate files.
+
+    Without keep_intermediates the render is streamed through memory and pipes, see
+    render_pcm, trim_stream and encode_mp3. progress is called with the name of every
+    finished stage ("midi", "synth", "encode"). With quiet the output of fluidsynth is
+    discarded. Gaps above max_reasonable_gap are capped. With a RenderCache, the stages of
+    a streamed render are skipped if their output is cached. Returns the MP3 file, or None
+    if the sequence is too short.
+    """
+    progress = progress or (lambda stage: None)
     # Create output directory if it doesn't exist
-    output_dir = 'music_outputs'
     os.makedirs(output_dir, exist_ok=True)
 
     # Set default output filename based on sequence name if not provided
     if mp3_filename is None:
-        mp3_filename = os.path.join(output_dir, f"{name.lower()}.mp3")
-    
-    # Create temporary files if not keeping intermediates
-    if keep_intermediates:
-        midi_file = os.path.join(output_dir, f"{name.lower()}.mid")
-        wav_file = os.path.join(output_dir, f"{name.lower()}.wav")
-    else:
-        temp_dir = tempfile.gettempdir()
-        midi_file = os.path.join(temp_dir, "temp_sequence.mid")
-        wav_file = os.path.join(temp_dir, "temp_sequence.wav")
-    
+        mp3_filename = mp3_path(name, output_dir)
+
     # Compute gaps and create MIDI
     gaps = compute_gaps(sequence)
-    
+    if not len(gaps):
+        print("Warning: Sequence has no gaps (needs at least 2 elements)")
+        return None
     # Handle very large gaps by capping them
-    if gaps:
-        max_reasonable_gap = 10000  # Set a reasonable maximum gap
-        capped_gaps = [min(gap, max_reasonable_gap) for gap in gaps]
-        create_synth_midi(capped_gaps, filename=midi_file)
+    capped_gaps = np.minimum(gaps, max_reasonable_gap)
+
+    # Export under a temporary name, so an interrupted run leaves no partial MP3 behind
+    partial_filename = mp3_filename + ".part"
+    if keep_intermediates:
+        midi_file = os.path.join(output_dir, f"{name.lower()}.mid")
+        wav_file = os.path.join(output_dir, f"{name.lower()}.wav")
+        create_synth_midi(capped_gaps, filename=midi_file, instruments=instruments)
+        progress("midi")
+
+        # Convert MIDI to WAV
+        command = [
+            "fluidsynth", 
+            "-ni", sf2_file, midi_file, 
+            "-F", wav_file, "-r", "44100"
+        ]
+        subprocess.run(command, stdout=subprocess.DEVNULL if quiet else None, stderr=subprocess.DEVNULL if quiet else None)
+        progress("synth")
+        # There is a general problem that the midi takes too long until it detects 
+        # silence and ends the file.  Therefore we cut silence at the end of 
+        # the while when makeing the mp3
+        sound = AudioSegment.from_wav(wav_file)
+        trimmed_sound = trim_silence(sound)
+        trimmed_sound.export(partial_filename, format="mp3", bitrate=bitrate)
     else:
-        print("Warning: Sequence has no gaps (needs at least 2 elements)")
-        return
-    
-    # Convert MIDI to WAV
-    command = [
-        "fluidsynth", 
-        "-ni", sf2_file, midi_file, 
-        "-F", wav_file, "-r", "44100"
-    ]
-    subprocess.run(command)
-    # There is a general problem that the midi takes too long until it detects 
-    # silence and ends the file.  Therefore we cut silence at the end of 
-    # the while when makeing the mp3
-    sound = AudioSegment.from_wav(wav_file)
-    trimmed_sound = trim_silence(sound)
-    trimmed_sound.export(mp3_filename, format="mp3", bitrate="192k")
+        keys = render_keys(sequence, max_reasonable_gap, instruments, sf2_file, bitrate) if cache else None
+        cached_mp3 = cache.open("mp3", keys["mp3"]) if cache else None
+        if cached_mp3 is not None:
+            with cached_mp3, open(partial_filename, "wb") as f:
+                shutil.copyfileobj(cached_mp3, f)
+            progress("midi")
+            progress("synth")
+        else:
+            # The synthesizer, the trimming and the encoder run chunk by chunk at the same time
+            encode_mp3(trimmed_pcm(capped_gaps, sf2_file, instruments, quiet, progress, cache, keys),
+                       partial_filename, bitrate=bitrate)
+            if cache:
+                cache.store_file("mp3", keys["mp3"], partial_filename)
+    os.replace(partial_filename, mp3_filename)
+    progress("encode")
     print(f"Created MP3 file: {mp3_filename}")
-    
-    # Clean up temporary files if not keeping intermediates
-    if not keep_intermediates:
-        try:
-            os.remove(midi_file)
-            os.remove(wav_file)
-        except:
-            pass  # Ignore errors in cleanup
+    return mp3_filename
+
+def parse_a_numbers(specs):
+    """
+    Return the sequence ids of a list of A-numbers and ranges, in order and without duplicates.
+
+    Accepted forms are A000045, 45 and ranges like A000001-A000100 or 1-100 (inclusive).
+    """
+    seq_ids = []
+    for spec in specs:
+        match = re.fullmatch(r"A?(\d+)(?:-A?(\d+))?", spec.strip(), re.IGNORECASE)
+        if match is None:
+            raise ValueError(f"Not an A-number or a range of A-numbers: {spec}")
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) else first
+        seq_ids.extend(range(first, last + 1))
+    return list(dict.fromkeys(seq_ids))
+
+def render_job(seq_id, data_path, output_dir, sf2_file, events, bitrate="192k", cache_settings=None):
+    """
+    Render one sequence of a seq folder to MP3 in a worker process.
+
+    Finished stages are put on the events queue as (seq_id, stage). cache_settings are the
+    (root, max_bytes) of the render cache, if one is used. Returns (seq_id, status), where
+    status is "rendered", "too short" or the error message.
+    """
+    name = f"A{seq_id:06d}"
+    # One cache per worker, so its size is counted once and not on the first write of every job
+    cache = process_cache(*cache_settings) if cache_settings else None
+    try:
+        sequence = read_terms(seq_path(data_path, seq_id))
+        events.put((seq_id, "read"))
+        # The track durations printed by the MIDI generation and the "Created MP3 file"
+        # line would drown the progress bars
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            mp3_file = sequence_to_mp3(sequence, name, output_dir=output_dir, sf2_file=sf2_file, quiet=True,
+                                       progress=lambda stage: events.put((seq_id, stage)),
+                                       bitrate=bitrate, cache=cache)
+        return seq_id, "rendered" if mp3_file else "too short"
+    except Exception as e:
+        return seq_id, f"{type(e).__name__}: {e}"
+
+def render_batch(seq_ids, data_path=DATA_PATH, output_dir=OUTPUT_DIR, sf2_file="FluidR3_GM.sf2", workers=None, force=False,
+                 bitrate="192k", cache=None):
+    """
+    Render many sequences of a seq folder in a process pool, with one progress bar per stage.
+
+    Sequences with an existing MP3 in output_dir are skipped unless force is set. The
+    workers share the RenderCache cache, if one is given.
+    Returns a dict from sequence id to status.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    todo = [seq_id for seq_id in seq_ids
+            if force or not os.path.exists(mp3_path(f"A{seq_id:06d}", output_dir))]
+    rendering = set(todo)
+    results = {seq_id: "exists" for seq_id in seq_ids if seq_id not in rendering}
+    print(f"{len(todo)} sequences to render, {len(results)} already rendered.")
+    bars = {stage: tqdm(total=len(todo), desc=f"{stage:>6}", unit="seq", position=i)
+            for i, stage in enumerate(STAGES)}
+
+    def drain(events):
+        while not events.empty():
+            _, stage = events.get()
+            bars[stage].update(1)
+
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+        events = manager.Queue()
+        cache_settings = (cache.root, cache.max_bytes) if cache else None
+        pending = {executor.submit(render_job, seq_id, data_path, output_dir, sf2_file, events, bitrate, cache_settings)
+                   for seq_id in todo}
+        while pending:
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            drain(events)
+            for future in done:
+                seq_id, status = future.result()
+                results[seq_id] = status
+        drain(events)
+    for bar in bars.values():
+        bar.close()
+    if cache:
+        # The workers only counted their own writes, so the shared cache may be over its limit
+        cache.evict()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Turn integer sequences into music')
+    parser.add_argument('a_numbers', nargs='*', help='A-numbers or ranges (A000001-A000100) to render from the seq folder; without any, SEQUENCE is rendered')
+    parser.add_argument('--seq', type=str, help=f'seq folder to read the sequences from (default: {DATA_PATH})', default=DATA_PATH)
+    parser.add_argument('-o', '--output-dir', type=str, help=f'Output folder (default: {OUTPUT_DIR})', default=OUTPUT_DIR)
+    parser.add_argument('--sf2', type=str, help='SoundFont file (default: FluidR3_GM.sf2)', default='FluidR3_GM.sf2')
+    parser.add_argument('-w', '--workers', type=int, help='Number of worker processes (default: number of CPUs)', default=None)
+    parser.add_argument('--force', action='store_true', help='Render sequences again that already have an MP3')
+    parser.add_argument('--bitrate', type=str, help='MP3 bitrate (default: 192k)', default='192k')
+    parser.add_argument('--cache', type=str, nargs='?', const=DEFAULT_CACHE_DIR, help=f'Cache the MIDI, PCM and MP3 of batch renders in this folder (default: {DEFAULT_CACHE_DIR})', default=None)
+    parser.add_argument('--cache-size', type=int, help=f'Size limit of the cache in MB, least recently used renders are evicted (default: {DEFAULT_MAX_BYTES // 1024 ** 2})', default=DEFAULT_MAX_BYTES // 1024 ** 2)
+    args = parser.parse_args()
+
+    if not args.a_numbers:
+        if args.cache:
+            parser.error("--cache only applies to batch renders, give A-numbers to render")
+        sequence_to_mp3(SEQUENCE, NAME, mp3_filename=None, keep_intermediates=True, sf2_file=args.sf2, output_dir=args.output_dir,
+                        bitrate=args.bitrate)
+        return
+
+    try:
+        seq_ids = parse_a_numbers(args.a_numbers)
+    except ValueError as e:
+        parser.error(str(e))
+    cache = RenderCache(args.cache, args.cache_size * 1024 ** 2) if args.cache else None
+    results = render_batch(seq_ids, args.seq, args.output_dir, args.sf2, args.workers, args.force, args.bitrate, cache)
+    failed = {seq_id: status for seq_id, status in results.items() if status not in ("rendered", "exists", "too short")}
+    statuses = list(results.values())
+    print(f"Rendered {statuses.count('rendered')}, skipped {statuses.count('exists')} existing and "
+          f"{statuses.count('too short')} too short sequences, {len(failed)} failed.")
+    for seq_id, status in sorted(failed.items()):
+        print(f"A{seq_id:06d}: {status}")
 
 # Main execution
 if __name__ == "__main__":
-    sequence_to_mp3(SEQUENCE, NAME, mp3_filename=None, keep_intermediates=True, sf2_file="FluidR3_GM.sf2")
\ No newline at end of file
+    main()
\ No newline at end of file